@@ -0,0 +1,755 @@
+import sys
+import time
+import signal
+from collections import OrderedDict
+import asyncio
+import queue
+import multiprocessing as mp
+from array import array
+from contextlib import asynccontextmanager, nullcontext
+import pymodbus
+from pymodbus.client import AsyncModbusTcpClient
+
+from main_modbus import ModbusProxier, ModbusDispatcher, assert_data
+import backpressure
+import pipeline
+
+class AsyncModbusProxier(ModbusProxier):
+    """
+    asyncio variant of ModbusProxier built on AsyncModbusTcpClient. Same config, slots and encoding;
+    every method that talks to a server is a coroutine, so many servers can be driven from one event loop.
+
+    AsyncModbusTcpClient holds a lock from sending a request until its response, so the requests to one server go one round
+    trip at a time whatever is gathered. As with ModbusProxier, the unverified FC16 requests of a flush to a server with a
+    pipeline_window above 1 are pipelined on a second connection, which the display must accept.
+    """
+    def __init__(self, config, batching=False, shadow=True):
+        # type: (str | dict, bool, bool) -> None
+        super(AsyncModbusProxier, self).__init__(config, batching, shadow)
+        self.request_locks = { it["name"]: asyncio.Lock() for it in self.config["servers"] } # type: dict[str, asyncio.Lock] # held around each request, so retire() can wait for it
+        self.connecting = { it["name"]: asyncio.Lock() for it in self.config["servers"] } # type: dict[str, asyncio.Lock]
+
+    def reload(self, config=None):
+        # type: (str | dict | None) -> tuple[set[str], set[str], set[str]]
+        locks = dict(self.request_locks)
+        ret = super(AsyncModbusProxier, self).reload(config)
+        reconnected = ret[2]
+        self.request_locks = { it["name"]: asyncio.Lock() if it["name"] in reconnected else locks.get(it["name"]) or asyncio.Lock()
+                               for it in self.config["servers"] }
+        self.connecting = { it["name"]: self.connecting.get(it["name"]) or asyncio.Lock() for it in self.config["servers"] }
+        return ret
+
+    def retire(self, name, client, lock, pipe=None):
+        # type: (str, AsyncModbusTcpClient, threading.Lock | None, pipeline.AsyncModbusPipeline | None) -> None
+        """
+        Close a replaced client and the connection of its pipelined writes once the requests on them are answered, or right away outside an event loop.
+        """
+        request_lock = self.request_locks.get(name) # still the old one while reload() runs
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None:
+            client.close()
+            if pipe is not None:
+                pipe.close()
+            return
+        async def close_when_idle():
+            async with request_lock if request_lock is not None else nullcontext():
+                client.close()
+            if pipe is not None:
+                async with pipe.lock:
+                    pipe.close()
+        loop.create_task(close_when_idle())
+
+    def create_client(self, server):
+        # type: (dict[str]) -> AsyncModbusTcpClient
+        return AsyncModbusTcpClient(server["host"],
+                                    port=server.get("port", 502),
+                                    framer=server.get("framer", pymodbus.Framer.SOCKET),
+                                    timeout=server.get("connect_timeout", self.config.get("connect_timeout", 1.0)))
+
+    def create_pipeline(self, server):
+        # type: (dict[str]) -> pipeline.AsyncModbusPipeline
+        return pipeline.AsyncModbusPipeline(server["host"],
+                                            port=server.get("port", 502),
+                                            timeout=server.get("connect_timeout", self.config.get("connect_timeout", 1.0)))
+
+    async def connect(self, client):
+        # type: (AsyncModbusTcpClient) -> bool
+        lock = self.connecting.get(self.names.get(id(client)))
+        if lock is None:
+            return await self.connect_unlocked(client)
+        async with lock: # requests in flight together connect once
+            if client.connected:
+                return True
+            return await self.connect_unlocked(client)
+
+    async def connect_unlocked(self, client):
+        # type: (AsyncModbusTcpClient) -> bool
+        name = self.names.get(id(client))
+        if name in self.down:
+            return False
+        ok = await client.connect()
+        self.record_connect(client, ok)
+        if not ok:
+            print(f"Failed to connect to {client.comm_params.host}:{client.comm_params.port}.", file=sys.stderr)
+            if name is not None:
+                self.mark_down(name)
+            return False
+        return True
+
+    async def connect_all(self, timeout=None):
+        # type: (float | None) -> dict[str, bool]
+        """
+        Connect every server concurrently, see ModbusProxier.connect_all.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        tasks = [ asyncio.create_task(self.connect(client)) for client in self.clients.values() if not client.connected ]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        ret = { name: client.connected for name, client in self.clients.items() }
+        self.report(ret)
+        return ret
+
+    def mark_down(self, name):
+        # type: (str) -> None
+        with self.lock:
+            _, delay = self.down.get(name, (0.0, 0.0))
+            delay = min(max(delay * 2, self.backoff_min), self.backoff_max)
+            self.down[name] = (time.monotonic() + delay, delay)
+            if self.reconnector is None:
+                try:
+                    self.reconnector = asyncio.get_running_loop().create_task(self.reconnect_loop())
+                except RuntimeError:
+                    pass # no loop; connect() retries once the entry is gone
+
+    async def reconnect_loop(self):
+        while True:
+            with self.lock:
+                if not self.down:
+                    self.reconnector = None
+                    return
+                name, (at, _) = min(self.down.items(), key=lambda it: it[1][0])
+            wait = at - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(min(wait, 0.5))
+                continue
+            client = self.clients.get(name)
+            if client is None:
+                with self.lock:
+                    self.down.pop(name, None)
+                continue
+            if not await self.reconnect(client):
+                self.mark_down(name)
+                continue
+            with self.lock:
+                self.probing.add(name)
+            try:
+                ok, sent = await self.flush_parked(name)
+            finally:
+                with self.lock:
+                    self.probing.discard(name)
+            if not ok:
+                self.mark_down(name)
+                continue
+            with self.lock:
+                self.down.pop(name, None)
+                self.failures[name] = 0 if sent else self.breaker_failures - 1
+            print(f"Reconnected to {name}" + (f", flushed {sent} registers." if sent else "."), file=sys.stderr)
+
+    async def flush_parked(self, server):
+        # type: (str) -> tuple[bool, int]
+        """
+        Send the last known image overlaid with the parked writes, see ModbusProxier.flush_parked.
+        """
+        with self.lock:
+            keys = set(it for it in self.shadow if it[0] == server) | set(it for it in self.parked if it[0] == server)
+            images = {}
+            for it in keys:
+                image = dict(self.shadow.get(it, {}))
+                image.update(self.parked.pop(it, {}))
+                images[it] = image
+        self.invalidate(server)
+        rets = await asyncio.gather(*(self.send_pending(server, slave, image) for (_, slave), image in images.items()))
+        return all(rets), sum(len(it) for it in images.values())
+
+    async def reconnect(self, client):
+        # type: (AsyncModbusTcpClient) -> bool
+        ok = client.connected or await client.connect()
+        self.record_connect(client, ok)
+        return ok
+
+    async def write_str(self, slot, msg, color, encoding="utf-8"):
+        # type: (str, str, int, str) -> bool
+        v = self.encode_str(slot, msg, color, encoding)
+        if v is None:
+            return False
+        return await self.write_registers(slot, v)
+
+    async def write_str_without_color(self, slot, msg, encoding="utf-8"):
+        # type: (str, str, str) -> bool
+        v = self.encode_str(slot, msg, None, encoding)
+        if v is None:
+            return False
+        return await self.write_registers(slot, v)
+
+    async def write_color(self, slot, color):
+        # type: (str, int) -> bool
+        return await self.write_registers(slot, color, -1)
+
+    async def write_bytes(self, slot, msg, offset=0):
+        # type: (str, bytes, int) -> bool
+        """
+        - offset: in WORD
+        """
+        return await self.write_registers(slot, self.registers_from_bytes(msg, tailling=self.tailing_byte), offset)
+
+    async def write_registers(self, slot, values, offset=0):
+        # type: (str, list[int] | int, int) -> bool
+        if self.batching:
+            return self.stage_registers(slot, values, offset)
+        if slot not in self.slots:
+            print(f"Slot {slot} not found.", file=sys.stderr)
+            return False
+        s = self.slots[slot]
+        v = [values] if isinstance(values, int) else values[:]
+        if offset < 0:
+            offset = s.length + offset
+        full_length = s.length - offset
+        if len(v) > full_length:
+            v = v[:full_length]
+        return await self.write_image(s.server, s.slave, s.address + offset, v)
+
+    async def flush(self, server=None):
+        # type: (str | None) -> bool
+        """
+        Send the staged writes, each contiguous register range as one FC16 request of at most MAX_WRITE_REGISTERS registers.
+        Different servers are flushed concurrently.
+
+        # Args
+        - server: only flush the writes bound for this server. if None, flush all.
+        """
+        with self.lock:
+            keys = [ it for it in self.pending if server is None or it[0] == server ]
+            batches = [ (it, self.pending.pop(it)) for it in keys ]
+
+        rets = await asyncio.gather(*(self.send_pending(name, slave, pending) for (name, slave), pending in batches))
+        return all(rets)
+
+    async def send_pending(self, server, slave, pending):
+        # type: (str, int, dict[int, int]) -> bool
+        requests = self.order_requests(server, slave, self.coalesce(pending, self.MAX_WRITE_REGISTERS))
+        if self.windows.get(server, 1) > 1 and len(requests) > 1:
+            return await self.write_pipelined(server, slave, requests)
+        ret = True
+        for address, values in requests:
+            ret = await self.write_image(server, slave, address, values) and ret
+        return ret
+
+    async def write_pipelined(self, server, slave, requests):
+        # type: (str, int, list[tuple[int, list[int] | array]]) -> bool
+        """
+        See ModbusProxier.write_pipelined.
+        """
+        plain = self.split_pipelined(server, slave, requests)
+        if plain is None:
+            return False
+        ret = True
+        for address, values, verify in plain:
+            if verify:
+                ret = await self.write_image(server, slave, address, values, verify=True) and ret
+        plain = [ (address, values) for address, values, verify in plain if not verify ]
+        if not plain:
+            return ret
+        if self.breaker_state(server) == "open":
+            for address, values in plain:
+                self.park(server, slave, address, values)
+            return False
+        results = await self.pipeline_for(server).write_many(slave, plain, self.windows.get(server, 1))
+        return self.record_pipelined(server, slave, plain, results) and ret
+
+    async def write_many(self, updates, encoding="utf-8"):
+        # type: (list[tuple[str, str, int]], str) -> dict[str, bool]
+        """
+        Write several (slot, msg, color) at once, see ModbusProxier.write_many. Different servers are written concurrently.
+        """
+        ret, servers = self.encode_many(updates, encoding)
+
+        async def write_server(name, writes):
+            if self.batching:
+                return all([ self.stage_registers(slot, v) for slot, v in writes ])
+            oks = await asyncio.gather(*(self.send_pending(name, slave, it) for slave, it in self.merge_writes(writes).items()))
+            return all(oks)
+
+        oks = await asyncio.gather(*(write_server(name, writes) for name, writes in servers.items()))
+        for ok, writes in zip(oks, servers.values()):
+            ret.update((slot, ok) for slot, _ in writes)
+        return ret
+
+    async def write_image(self, server, slave, address, values, verify=None):
+        # type: (str, int, int, list[int], bool | None) -> bool
+        if self.breaker_state(server) == "open":
+            self.park(server, slave, address, values)
+            return False
+        diff = self.diff_image(server, slave, address, values)
+        if diff is None:
+            return True
+        address, values = diff
+        verify = self.should_verify(server, slave, address, len(values)) if verify is None else verify
+        actual = None
+        async with self.request_locks[server]:
+            client = self.clients[server] # looked up under the lock, as reload() may replace it
+            t = time.perf_counter()
+            if verify and self.fc23[server] and len(values) <= self.MAX_READWRITE_REGISTERS:
+                actual = await self.readwrite_registers_raw(client, address, values, slave)
+                ok = actual is not None
+                self.record_io(server, "readwrite", len(values), ok, time.perf_counter() - t)
+            else:
+                ok = await self.write_registers_raw(client, address, values, slave)
+                self.record_io(server, "write", len(values), ok, time.perf_counter() - t)
+                if ok and verify:
+                    t = time.perf_counter()
+                    actual = await self.read_holding_registers_raw(client, address, len(values), slave)
+                    self.record_io(server, "read", len(values), actual is not None, time.perf_counter() - t)
+        if not ok:
+            self.record_failure(server, slave, address, values)
+            return False
+        self.record_success(server, slave, address, len(values))
+        if verify:
+            return self.check_readback(server, slave, address, values, actual)
+        self.update_image(server, slave, address, values)
+        return True
+
+    @asynccontextmanager
+    async def batch(self):
+        """
+        Stage every write in the `async with` block and flush them on exit.
+        """
+        batching = self.batching
+        self.batching = True
+        try:
+            yield self
+        finally:
+            self.batching = batching
+            await self.flush()
+
+    async def write_registers_raw(self, client, address, values, slave):
+        # type: (AsyncModbusTcpClient, int, list[int] | int, int) -> bool
+        if not client.connected:
+            if not await self.connect(client): return False
+        if isinstance(values, array):
+            values = values.tolist() # pymodbus only takes a list or a single int
+
+        try:
+            rr = await client.write_registers(address, values, slave=slave)
+        except pymodbus.ModbusException as e:
+            print(f"Received ModbusException({e})", file=sys.stderr)
+            return False
+
+        if rr.isError():
+            print(f"Received Modbus library error({rr})", file=sys.stderr)
+            return False
+
+        return True
+
+    async def readwrite_registers_raw(self, client, address, values, slave):
+        # type: (AsyncModbusTcpClient, int, list[int] | array, int) -> list[int] | None
+        if not client.connected:
+            if not await self.connect(client): return None
+        if isinstance(values, array):
+            values = values.tolist()
+        try:
+            rr = await client.readwrite_registers(read_address=address, read_count=len(values), write_address=address, values=values, slave=slave)
+        except pymodbus.ModbusException as e:
+            print(f"Received ModbusException({e})", file=sys.stderr)
+            return None
+
+        if rr.isError():
+            print(f"Received Modbus library error({rr})", file=sys.stderr)
+            return None
+
+        return rr.registers
+
+    async def read_holding_registers_raw(self, client, address, count, slave):
+        # type: (AsyncModbusTcpClient, int, int, int) -> list[int]
+        if not client.connected:
+            if not await self.connect(client): return None
+        try:
+            rr = await client.read_holding_registers(address, count, slave)
+        except pymodbus.ModbusException as e:
+            print(f"Received ModbusException({e})", file=sys.stderr)
+            return None
+
+        if rr.isError():
+            print(f"Received Modbus library error({rr})", file=sys.stderr)
+            return None
+
+        return rr.registers
+
+    async def read_holding_registers(self, slot, count=None, offset=0, force=False, max_age=None):
+        # type: (str, int, int, bool, float | None) -> list[int]
+        if slot not in self.slots:
+            print(f"Slot {slot} not found.", file=sys.stderr)
+            return None
+        s = self.slots[slot]
+        if offset < 0:
+            offset = s.length + offset
+        if count is None or count < 0 or count > s.length:
+            count = s.length
+        if count > s.length - offset:
+            count = s.length - offset
+        if not force:
+            ret = self.read_image(s.server, s.slave, s.address + offset, count, self.max_age if max_age is None else max_age)
+            if ret is not None:
+                return ret
+        return await self.read_block(s.server, s.slave, s.address + offset, count)
+
+    async def read_block(self, server, slave, address, count):
+        # type: (str, int, int, int) -> list[int] | None
+        async with self.request_locks[server]:
+            t = time.perf_counter()
+            ret = await self.read_holding_registers_raw(self.clients[server], address, count, slave)
+            self.record_io(server, "read", count, ret is not None, time.perf_counter() - t)
+        if ret is not None:
+            self.update_image(server, slave, address, ret)
+        return ret
+
+    async def read_str(self, slot, count=None, encoding="utf-8", force=False, max_age=None):
+        # type: (str, int | None, str, bool, float | None) -> str
+        if slot not in self.slots:
+            print(f"Slot {slot} not found.", file=sys.stderr)
+            return None
+        s = self.slots[slot]
+        if count is None or count < 0 or count > s.length - 1:
+            count = s.length - 1
+        ret = await self.read_holding_registers(slot, count, force=force, max_age=max_age)
+        if ret is not None:
+            ret = self.registers_to_str(ret, encoding)
+        return ret
+
+    async def read_color(self, slot, force=False, max_age=None):
+        # type: (str, bool, float | None) -> int
+        ret = await self.read_holding_registers(slot, 1, -1, force=force, max_age=max_age)
+        ret = ret[0] if ret is not None else 0
+        return ret
+
+    def close(self):
+        for it in self.clients.values():
+            it.close()
+        for it in self.pipelines.values():
+            it.close()
+        self.pipelines = {}
+
+
+class AsyncModbusLane:
+    def __init__(self, proxier, server, max_frame_rate=None, max_batch=None):
+        # type: (AsyncModbusProxier, str, float | None, int | None) -> None
+        """
+        Task owning all writes to one server, see ModbusLane.
+        """
+        self.proxier = proxier
+        self.server = server
+        self.interval = 1.0 / max_frame_rate if max_frame_rate else 0.0
+        self.next_flush = 0.0
+        self.event = asyncio.Event()
+        self.pending = OrderedDict() # type: OrderedDict[str, dict[str]] # slot -> latest message not sent yet
+        self.collapsed = 0
+        self.since = {} # type: dict[str, float]
+        self.max_batch = max_batch
+        self.running = True
+
+    def put(self, msg):
+        # type: (dict[str]) -> None
+        self.put_many([msg])
+
+    def configure(self, max_frame_rate=None, max_batch=None):
+        # type: (float | None, int | None) -> None
+        self.interval = 1.0 / max_frame_rate if max_frame_rate else 0.0
+        self.max_batch = max_batch
+        self.next_flush = min(self.next_flush, time.monotonic() + self.interval)
+
+    def evict(self):
+        # type: () -> list[dict[str]]
+        slots = [ it for it in self.pending if it not in self.proxier.slots or self.proxier.slots[it].server != self.server ]
+        for it in slots:
+            self.since.pop(it, None)
+        return [ self.pending.pop(it) for it in slots ]
+
+    def take(self):
+        # type: () -> list[dict[str]]
+        slots = self.proxier.slots
+        mine = { it: t for it, t in self.since.items() if it in slots and slots[it].server == self.server } # see ModbusLane.take
+        slots = self.proxier.by_priority(mine)[:self.max_batch]
+        for it in slots:
+            del self.since[it]
+        return [ self.pending.pop(it) for it in slots ]
+
+    def put_many(self, msgs):
+        # type: (list[dict[str]]) -> None
+        for msg in msgs:
+            if msg["slot"] in self.pending:
+                self.collapsed += 1
+                self.proxier.metrics.inc("collapsed_total", server=self.server)
+            else:
+                self.since[msg["slot"]] = time.monotonic()
+            self.pending[msg["slot"]] = msg
+        self.event.set()
+
+    async def process_one(self):
+        # type: () -> bool
+        await self.event.wait()
+        self.event.clear()
+        if not self.pending:
+            return False
+        delay = self.next_flush - time.monotonic()
+        if delay > 0 and self.running:
+            await asyncio.sleep(delay) # keep collecting until the tick
+        msgs = self.take()
+        if self.pending:
+            self.event.set() # the rest goes out on the next tick
+        self.next_flush = time.monotonic() + self.interval
+
+        self.proxier.metrics.observe_age("queue_wait_seconds", msgs, server=self.server)
+        sent = self.proxier.requests.get(self.server, 0)
+        ret = await self.proxier.write_many([ (it["slot"], it["msg"], it["color"]) for it in msgs ], encoding="gb2312")
+        sent = self.proxier.requests.get(self.server, 0) - sent
+        if sent > 1:
+            self.next_flush += self.interval * (sent - 1) # see ModbusLane.process_one
+        self.proxier.metrics.observe_age("update_latency_seconds", msgs, server=self.server)
+        return all(ret.values())
+
+    async def run(self):
+        while self.running:
+            try:
+                await self.process_one()
+            except Exception as e:
+                print(f"Lane of {self.server} failed to send ({e!r}), carrying on.", file=sys.stderr)
+
+    def stop(self):
+        self.running = False
+        self.event.set()
+
+
+class AsyncModbusDispatcher:
+    def __init__(self, proxier, capacity=50, q=None, policy=None):
+        # type: (AsyncModbusProxier | str | dict, int, None | asyncio.Queue | mp.Queue, str | None) -> None
+        """
+        # Args
+        - proxier: an instance of AsyncModbusProxier or a config file or an dict containing the config
+        - capacity: capacity of the queue. ignored if q is not None.
+        - q: asyncio.Queue[dict[str]] or multiprocessing.Queue[dict[str]] with { "slot": slot, "msg": msg, "color": color, "t": t } or { "updates": [...] } inside, see ModbusDispatcher. if None, asyncio.Queue will be created automatically.
+        - policy: what push does when the queue is full, see ModbusDispatcher.
+        """
+        self.capacity = capacity
+
+        if q is not None:
+            self.queue = q # type: asyncio.Queue[dict[str]] | mp.Queue[dict[str]]
+        else:
+            self.queue = asyncio.Queue(maxsize=self.capacity) # type: asyncio.Queue[dict[str]]
+
+        if isinstance(proxier, AsyncModbusProxier):
+            self.proxier = proxier
+        else:
+            self.proxier = AsyncModbusProxier(proxier)
+
+        self.policy = policy or self.proxier.config.get("overflow_policy", "block") # type: str
+        if self.policy not in backpressure.POLICIES:
+            raise ValueError(f"Unknown overflow policy {self.policy}, expected one of {backpressure.POLICIES}.")
+
+        self.lanes = { it["name"]: AsyncModbusLane(self.proxier, it["name"], it.get("max_frame_rate"), it.get("max_batch"))
+                       for it in self.proxier.config["servers"] } # type: dict[str, AsyncModbusLane]
+        self.running = False
+
+        self.proxier.metrics.gauge("queue_depth", self.queue.qsize)
+        for name, it in self.lanes.items():
+            self.proxier.metrics.gauge("pending_slots", lambda it=it: len(it.pending), server=name)
+
+        self.tasks = {} # type: dict[str, asyncio.Task] # lane tasks while running
+        self.reload_requested = False
+        self.check_interval = self.proxier.config.get("reload_check_interval", 1.0) # type: float
+        self.next_check = time.monotonic() + self.check_interval
+        self.config_mtime = self.config_changed_at()
+
+    config_changed_at = ModbusDispatcher.config_changed_at
+    request_reload = ModbusDispatcher.request_reload
+    check_reload = ModbusDispatcher.check_reload
+
+    def reload(self, config=None):
+        # type: (str | dict | None) -> bool
+        """
+        See ModbusDispatcher.reload. Runs in the event loop, between two queue items.
+        """
+        try:
+            added, removed, reconnected = self.proxier.reload(config)
+        except Exception as e:
+            print(f"Failed to reload the config ({e}), keeping the old one.", file=sys.stderr)
+            return False
+        self.check_interval = self.proxier.config.get("reload_check_interval", 1.0)
+        policy = self.proxier.config.get("overflow_policy", self.policy)
+        if policy in backpressure.POLICIES:
+            self.policy = policy
+        else:
+            print(f"Unknown overflow policy {policy}, keeping {self.policy}.", file=sys.stderr)
+
+        orphans = []
+        for name in removed:
+            lane = self.lanes.pop(name)
+            lane.stop()
+            self.tasks.pop(name, None)
+            orphans += lane.evict()
+        for it in self.proxier.config["servers"]:
+            if it["name"] in self.lanes:
+                self.lanes[it["name"]].configure(it.get("max_frame_rate"), it.get("max_batch"))
+                continue
+            lane = AsyncModbusLane(self.proxier, it["name"], it.get("max_frame_rate"), it.get("max_batch"))
+            self.lanes[it["name"]] = lane
+            self.proxier.metrics.gauge("pending_slots", lambda lane=lane: len(lane.pending), server=it["name"])
+            if self.running:
+                self.tasks[it["name"]] = asyncio.create_task(lane.run())
+        for lane in list(self.lanes.values()):
+            orphans += lane.evict()
+        for it in orphans:
+            self.route(it)
+        print(f"Reloaded the config: added {sorted(added)}, removed {sorted(removed)}, reconnected {sorted(reconnected)}.", file=sys.stderr)
+        return True
+
+    @property
+    def collapsed(self):
+        # type: () -> int
+        return sum(it.collapsed for it in self.lanes.values())
+
+    async def push(self, slot, msg, color):
+        # type: (str, str, int) -> bool
+        """
+        Only for an asyncio.Queue. Producers in other processes put into the mp.Queue directly.
+        Returns False if the update was dropped by the overflow policy.
+        """
+        if slot not in self.proxier.slots:
+            print(f"Slot {slot} not found.", file=sys.stderr)
+            return False
+        return await self.offer(dict(slot=slot, msg=msg, color=color, t=time.time()))
+
+    async def offer(self, item):
+        # type: (dict[str]) -> bool
+        if self.policy != "block":
+            return backpressure.offer(self.queue, item, self.proxier.metrics, self.policy, backpressure.capacity_of(self.queue, self.capacity))
+        if self.queue.full():
+            self.proxier.metrics.inc("push_full_total", policy=self.policy)
+            with self.proxier.metrics.timer("push_wait_seconds"):
+                await self.queue.put(item)
+        else:
+            self.queue.put_nowait(item)
+        return True
+
+    async def push_many(self, updates):
+        # type: (list[tuple[str, str, int]]) -> dict[str, bool]
+        """
+        Push several (slot, msg, color) as one queue item, see ModbusDispatcher.push_many. Only for an asyncio.Queue.
+        """
+        ret = {}
+        batch = []
+        for slot, msg, color in updates:
+            if slot not in self.proxier.slots:
+                print(f"Slot {slot} not found.", file=sys.stderr)
+                ret[slot] = False
+                continue
+            batch.append(dict(slot=slot, msg=msg, color=color, t=time.time()))
+        ok = await self.offer(dict(updates=batch)) if batch else False
+        for it in batch:
+            ret[it["slot"]] = ok
+        return ret
+
+    def route(self, msg):
+        # type: (dict[str]) -> bool
+        lanes = OrderedDict() # type: OrderedDict[str, list[dict[str]]]
+        ret = True
+        for it in msg.get("updates", [msg]):
+            if it["slot"] not in self.proxier.slots:
+                print(f"Slot {it['slot']} not found.", file=sys.stderr)
+                ret = False
+                continue
+            lanes.setdefault(self.proxier.slots[it["slot"]].server, []).append(it)
+        for server, msgs in lanes.items():
+            self.lanes[server].put_many(msgs)
+        return ret
+
+    async def get(self):
+        # type: () -> dict[str] | None
+        """
+        Returns the next queue item, or None after reload_check_interval without one.
+        """
+        if isinstance(self.queue, asyncio.Queue):
+            try:
+                return await asyncio.wait_for(self.queue.get(), self.check_interval)
+            except asyncio.TimeoutError:
+                return None
+        # mp.Queue blocks, so wait in a worker thread with a timeout to notice stop()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self.queue.get, True, min(self.check_interval, 0.5))
+        except queue.Empty:
+            return None
+
+    async def run(self):
+        self.running = True
+        if self.proxier.config.get("metrics_port"):
+            self.proxier.metrics.serve(self.proxier.config["metrics_port"]) # served from its own thread
+        await self.proxier.connect_all()
+        self.tasks = { name: asyncio.create_task(it.run()) for name, it in self.lanes.items() }
+        try:
+            while self.running:
+                msg = await self.get()
+                if msg is not None:
+                    self.route(msg)
+                self.check_reload()
+        finally:
+            for it in self.lanes.values():
+                it.stop()
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def stop(self):
+        self.running = False
+        if isinstance(self.queue, asyncio.Queue):
+            try:
+                self.queue.put_nowait(None) # wake up run()
+            except asyncio.QueueFull:
+                pass
+
+
+def dispatch_modbus_async(q):
+    dispatcher = AsyncModbusDispatcher("modbus-dispatcher.yaml", q=q)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, dispatcher.request_reload)
+    asyncio.run(dispatcher.run())
+
+
+# === For test ===
+
+async def main_async():
+    proxier = AsyncModbusProxier("modbus-dispatcher.yaml")
+    dispatcher = AsyncModbusDispatcher(proxier)
+    task = asyncio.create_task(dispatcher.run())
+    init_data = proxier.registers_from_bytes(bytes.fromhex("31 35 20 20 20 20 00 02 D5 FD D4 DA BC EC B3 B5 00 02 20 20 20 20 B3 B5 C1 BE D5 FD D4 DA BC EC B2 E2 A3 AC C7 EB D2 C0 B4 CE B4 F2 BF AA B3 B5 B5 C6 20 20 20 20 20 20 20 20 00 02 D3 D0 00 02 D3 D0 00 02 D3 D0 00 02 D3 D0 00 02 D7 F3 C1 C1 20 20 00 02 D3 D2 C1 C1 20 20 00 02 32 30 20 20 20 20 00 02 D7 F3 B2 BB C1 C1 00 01 D3 D2 B2 BB C1 C1 00 01 B2 BB C9 C1 CB B8 00 01 D7 F3 C1 C1 20 20 00 02 D3 D2 B2 BB C1 C1 00 01 C1 C1 C6 F0 20 20 00 02"), tailling=b'\x20')
+    await proxier.write_registers_raw(proxier.clients[proxier.slots[3].server], 0, init_data, 1)
+
+    for i, (slot, msg, color) in enumerate([(3, "没有检车项目", 1), (1, "625", 1), (2, "无项目", 1), (4, "AB", 1), (15, "0123", 2)]):
+        await dispatcher.push(slot, msg, color)
+        await asyncio.sleep(0.5)
+        assert_data(proxier.registers_to_bytes(await proxier.read_holding_registers_raw(proxier.clients[proxier.slots[slot].server], 0, 74, 1)), i)
+
+    assert (await proxier.read_str(3, encoding="gb2312")).strip() == "没有检车项目"
+    assert await proxier.read_color(3) == 1
+
+    print("All test passed.")
+
+    dispatcher.stop()
+    await task
+    proxier.close()
+
+def main():
+    asyncio.run(main_async())
+
+if __name__ == "__main__":
+    main()
+
+# --- For test ---
@@ -0,0 +1,148 @@
+"""Overflow policies for pushing into a full dispatcher queue.
+
+- block: wait for room, up to the timeout given to push (forever if None).
+- drop-newest: give up on the update being pushed.
+- drop-oldest: take the oldest queued item out to make room.
+- coalesce-by-slot: take everything queued out, drop the updates superseded by a later one
+  for the same slot, and put the rest back in order (as many as fit the capacity, newest first).
+  What is left of a batch goes back as one batch.
+
+With any policy but block, a push never waits, however far behind the
+displays are. Every policy counts into the dispatcher's Metrics:
+push_full_total (pushes that found the queue full), push_dropped_total and
+push_coalesced_total (updates), and push_wait_seconds for block.
+"""
+import time
+import queue
+import asyncio
+
+import metrics
+
+POLICIES = ("block", "drop-newest", "drop-oldest", "coalesce-by-slot")
+FULL = (queue.Full, asyncio.QueueFull)
+EMPTY = (queue.Empty, asyncio.QueueEmpty)
+RETRIES = 4 # room made by drop-oldest may be taken by another producer first
+TAKE_WAIT = 0.005 # seconds. items this process put into an mp.Queue may still be in its feeder thread
+
+
+def take(q):
+    # type: (queue.Queue) -> dict[str]
+    """
+    Take the oldest item out of a full q, from the producer side. Raises one of EMPTY.
+    """
+    if isinstance(q, asyncio.Queue):
+        return q.get_nowait()
+    return q.get(True, TAKE_WAIT)
+
+
+def updates_of(item):
+    # type: (dict[str]) -> list[dict[str]]
+    return item.get("updates", [item])
+
+
+def capacity_of(q, default=50):
+    # type: (queue.Queue, int) -> int
+    """
+    Returns how much q holds, in the units of `size_of`: ShmQueue.capacity, asyncio.Queue.maxsize or the maxsize of an mp.Queue.
+    """
+    for name in ("capacity", "maxsize", "_maxsize"):
+        n = getattr(q, name, None)
+        if isinstance(n, int) and n > 0:
+            return n
+    return default
+
+
+def size_of(q, item):
+    # type: (queue.Queue, dict[str]) -> int
+    """
+    Returns the room item takes in q: a ShmQueue stores a batch of n updates in n records, the other queues take it as one item.
+    """
+    return len(updates_of(item)) if hasattr(q, "capacity") else 1
+
+
+def offer(q, item, stats, policy="block", capacity=50, block=True, timeout=None):
+    # type: (queue.Queue, dict[str], metrics.Metrics, str, int, bool, float | None) -> bool
+    """
+    Put item into q, applying policy if q is full.
+
+    # Args
+    - q: mp.Queue, shm_queue.ShmQueue or asyncio.Queue (whose block policy needs `await q.put` instead)
+    - item: an update or { "updates": [...] } as taken by the dispatchers
+    - stats: where to count, e.g. the proxier's metrics
+    - policy: one of POLICIES
+    - capacity: of q (see capacity_of), the most coalesce-by-slot puts back
+    - block, timeout: as for q.put, used by the block policy only
+
+    Returns True if the updates of item are in q.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown overflow policy {policy}, expected one of {POLICIES}.")
+    try:
+        q.put_nowait(item)
+        return True
+    except FULL:
+        stats.inc("push_full_total", policy=policy)
+
+    if policy == "block":
+        if not block:
+            stats.inc("push_dropped_total", len(updates_of(item)), policy=policy)
+            return False
+        t = time.perf_counter()
+        try:
+            q.put(item, True, timeout)
+            return True
+        except FULL:
+            stats.inc("push_dropped_total", len(updates_of(item)), policy=policy)
+            return False
+        finally:
+            stats.observe("push_wait_seconds", time.perf_counter() - t)
+
+    if policy == "drop-oldest":
+        for _ in range(RETRIES):
+            try:
+                old = take(q)
+            except EMPTY:
+                old = None
+            if old is not None:
+                stats.inc("push_dropped_total", len(updates_of(old)), policy=policy)
+            try:
+                q.put_nowait(item)
+                return True
+            except FULL:
+                continue
+
+    if policy == "coalesce-by-slot":
+        items = [] # type: list[dict[str]] # oldest first
+        while True:
+            try:
+                items.append(take(q))
+            except EMPTY:
+                break
+        items.append(item)
+        latest = {} # type: dict[str, tuple[int, int]] # slot -> (index of the item, index in it) of its latest update
+        for i, it in enumerate(items):
+            for j, update in enumerate(updates_of(it)):
+                latest[update["slot"]] = (i, j)
+        kept = [] # type: list[tuple[int, dict[str]]] # (index in items, item)
+        for i, it in enumerate(items):
+            updates = [ update for j, update in enumerate(updates_of(it)) if latest[update["slot"]] == (i, j) ]
+            if len(updates) < len(updates_of(it)):
+                stats.inc("push_coalesced_total", len(updates_of(it)) - len(updates))
+            if not updates:
+                continue
+            if "updates" in it:
+                it = dict(it, updates=updates) # what is left of a batch still goes as one unit
+            kept.append((i, it))
+        while sum(size_of(q, it) for _, it in kept) > capacity:
+            stats.inc("push_dropped_total", len(updates_of(kept.pop(0)[1])), policy=policy)
+        ok = False
+        for i, it in kept:
+            try:
+                q.put_nowait(it)
+                ok = ok or i == len(items) - 1
+            except FULL: # taken meanwhile by another producer
+                stats.inc("push_dropped_total", len(updates_of(it)), policy=policy)
+        return ok
+
+    stats.inc("push_dropped_total", len(updates_of(item)), policy=policy) # drop-newest, or drop-oldest out of retries
+    return False
@@ -0,0 +1,225 @@
+"""Throughput / latency benchmark of the proxiers and the dispatcher.
+
+Drives ModbusProxier, LEDProxier and ModbusDispatcher against an in-process
+simulated display on localhost (simulator.py, or a running server with
+--server) and writes the results as JSON, so runs of different versions can be
+compared with --compare.
+
+usage::
+
+    python bench.py [--targets modbus,led,dispatcher] [--patterns cycle,burst,hot]
+                    [--updates 2000] [--distinct 0] [--server HOST:PORT] [--latency 0]
+                    [--output bench.json] [--compare old.json]
+"""
+import json
+import time
+import copy
+import platform
+import argparse
+import subprocess
+import yaml
+
+from main_modbus import ModbusProxier, ModbusDispatcher
+from main_socket import LEDProxier
+from metrics import Histogram
+from simulator import SimulatedDisplay
+
+
+def updates_for(pattern, slots, n, distinct=0):
+    # type: (str, list[int], int, int) -> list[list[tuple[int, str, int]]]
+    """
+    Returns n updates as groups of (slot, msg, color) sent together.
+
+    - cycle: one slot at a time, going round all slots.
+    - burst: every slot at once, n / len(slots) times.
+    - hot: the same slot over and over.
+    - distinct: if > 0, messages repeat after this many values (hits the payload cache and the shadow); 0 makes every message new.
+    """
+    def msg(i):
+        return str(i % distinct if distinct > 0 else i)
+    if pattern == "cycle":
+        return [ [(slots[i % len(slots)], msg(i), i % 3)] for i in range(n) ]
+    if pattern == "burst":
+        return [ [ (it, msg(i), i % 3) for it in slots ] for i in range(max(n // len(slots), 1)) ]
+    if pattern == "hot":
+        return [ [(slots[0], msg(i), i % 3)] for i in range(n) ]
+    raise ValueError(f"Unknown pattern {pattern}.")
+
+
+def quantiles(samples):
+    # type: (list[float]) -> tuple[float, float]
+    if not samples:
+        return float("nan"), float("nan")
+    samples = sorted(samples)
+    def at(q):
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+    return at(0.5), at(0.99)
+
+
+def bench_proxier(proxier, groups):
+    # type: (ModbusProxier | LEDProxier, list[list[tuple[int, str, int]]]) -> tuple[float, list[float]]
+    latencies = []
+    t0 = time.perf_counter()
+    for group in groups:
+        t = time.perf_counter()
+        if len(group) == 1:
+            proxier.write_str(*group[0], encoding="gb2312")
+        else:
+            proxier.write_many(group, encoding="gb2312")
+        latencies.extend([time.perf_counter() - t] * len(group))
+    return time.perf_counter() - t0, latencies
+
+
+def bench_dispatcher(dispatcher, groups, timeout=60.0):
+    # type: (ModbusDispatcher, list[list[tuple[int, str, int]]], float) -> tuple[float, tuple[float, float]]
+    """
+    Push every group and wait until each update was either sent or collapsed into a newer one.
+    Latency is enqueue-to-ack, from the dispatcher's metrics.
+    """
+    metrics = dispatcher.proxier.metrics
+    n = sum(len(it) for it in groups)
+    def done():
+        snap = metrics.snapshot()
+        acked = sum(it["count"] for it in snap["histograms"].get("update_latency_seconds", {}).values())
+        collapsed = sum(snap["counters"].get("collapsed_total", {}).values())
+        return acked + collapsed >= n
+
+    t0 = time.perf_counter()
+    for group in groups:
+        if len(group) == 1:
+            dispatcher.push(*group[0])
+        else:
+            dispatcher.push_many(group)
+    deadline = time.monotonic() + timeout
+    while not done() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - t0
+
+    merged = Histogram() # over all lanes
+    with metrics.lock:
+        for (name, _), it in metrics.histograms.items():
+            if name == "update_latency_seconds":
+                merged.counts = [ a + b for a, b in zip(merged.counts, it.counts) ]
+                merged.count += it.count
+    return elapsed, (merged.quantile(0.5), merged.quantile(0.99))
+
+
+def config_for(base, host, port):
+    # type: (dict, str, int) -> dict
+    config = copy.deepcopy(base)
+    for it in config["servers"]:
+        it["host"] = host
+        it["port"] = port
+        it.pop("max_frame_rate", None)
+    return config
+
+
+def run(target, pattern, config, args, display):
+    # type: (str, str, dict, argparse.Namespace, SimulatedDisplay | None) -> dict
+    slots = sorted(it["key"] for it in config["slots"])
+    groups = updates_for(pattern, slots, args.updates, args.distinct)
+    n = sum(len(it) for it in groups)
+    bytes_before = display.bytes_received if display else 0
+
+    if target == "modbus":
+        proxier = ModbusProxier(config)
+        elapsed, latencies = bench_proxier(proxier, groups)
+        p50, p99 = quantiles(latencies)
+        sent = sum(proxier.metrics.snapshot()["counters"].get("bytes_sent_total", {}).values())
+    elif target == "led":
+        proxier = LEDProxier(config)
+        elapsed, latencies = bench_proxier(proxier, groups)
+        p50, p99 = quantiles(latencies)
+        sent = sum(proxier.metrics.snapshot()["counters"].get("bytes_sent_total", {}).values())
+        proxier.close()
+    elif target == "dispatcher":
+        dispatcher = ModbusDispatcher(config, capacity=args.capacity)
+        dispatcher.daemon = True
+        dispatcher.start()
+        elapsed, (p50, p99) = bench_dispatcher(dispatcher, groups)
+        sent = sum(dispatcher.proxier.metrics.snapshot()["counters"].get("bytes_sent_total", {}).values())
+        dispatcher.stop()
+    else:
+        raise ValueError(f"Unknown target {target}.")
+
+    if display is not None:
+        time.sleep(0.05) # let the display read the last frames
+        sent = display.bytes_received - bytes_before
+    return dict(target=target, pattern=pattern, updates=n, seconds=elapsed,
+                updates_per_second=n / elapsed if elapsed > 0 else float("nan"),
+                latency_p50_ms=p50 * 1000, latency_p99_ms=p99 * 1000,
+                bytes_per_update=sent / n if n else float("nan"))
+
+
+def version():
+    # type: () -> str
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return ""
+
+
+def compare(results, path):
+    # type: (list[dict], str) -> None
+    with open(path, "r") as f:
+        old = { (it["target"], it["pattern"]): it for it in json.load(f)["results"] }
+    print(f"\nCompared with {path}:")
+    for it in results:
+        before = old.get((it["target"], it["pattern"]))
+        if before is None:
+            continue
+        ratio = it["updates_per_second"] / before["updates_per_second"] if before["updates_per_second"] else float("nan")
+        print(f"{it['target']:>10} {it['pattern']:>6}: {ratio:6.2f}x updates/s, "
+              f"p99 {before['latency_p99_ms']:.2f} -> {it['latency_p99_ms']:.2f} ms, "
+              f"{before['bytes_per_update']:.1f} -> {it['bytes_per_update']:.1f} B/update")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the proxiers and the dispatcher.")
+    parser.add_argument("--config", default="modbus-dispatcher.yaml")
+    parser.add_argument("--targets", default="modbus,led,dispatcher")
+    parser.add_argument("--patterns", default="cycle,burst,hot")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--distinct", type=int, default=0, help="messages repeat after this many values, 0 for all new")
+    parser.add_argument("--capacity", type=int, default=50, help="queue capacity of the dispatcher")
+    parser.add_argument("--server", help="HOST:PORT of a running server (e.g. simulator.py) instead of the in-process one")
+    parser.add_argument("--latency", type=float, default=0.0, help="response latency of the in-process display, in seconds")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        base = yaml.safe_load(f)
+
+    display = None
+    if args.server:
+        host, port = args.server.rsplit(":", 1)
+        port = int(port)
+    else:
+        display = SimulatedDisplay(latency=args.latency).start()
+        host, port = display.address
+    config = config_for(base, host, port)
+
+    results = []
+    for target in args.targets.split(","):
+        for pattern in args.patterns.split(","):
+            it = run(target, pattern, config, args, display)
+            results.append(it)
+            print(f"{target:>10} {pattern:>6}: {it['updates_per_second']:9.0f} updates/s, "
+                  f"p50 {it['latency_p50_ms']:.3f} ms, p99 {it['latency_p99_ms']:.3f} ms, "
+                  f"{it['bytes_per_update']:.1f} B/update")
+
+    if display is not None:
+        display.stop()
+
+    report = dict(version=version(), time=time.strftime("%Y-%m-%dT%H:%M:%S"), python=platform.python_version(),
+                  platform=platform.platform(), args=vars(args), results=results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
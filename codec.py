@@ -0,0 +1,85 @@
+"""Bulk conversion between big-endian byte payloads and 16-bit registers.
+
+Shared by ModbusProxier and LEDProxier. Each call converts a whole payload
+through array('H') instead of looping over byte pairs in Python.
+PayloadCache keeps recently encoded slot payloads.
+"""
+import sys
+import threading
+from collections import OrderedDict
+from array import array
+
+NATIVE_BIG_ENDIAN = sys.byteorder == "big"
+
+
+def registers_from_bytes(msg, tailling=b'\x00'):
+    # type: (bytes | bytearray | memoryview, bytes) -> array
+    """
+    Returns array('H') of the registers in msg, which can be any buffer. An odd length is padded with tailling.
+    """
+    if len(msg) % 2 == 1:
+        msg = bytes(msg) + tailling[:1]
+    regs = array("H")
+    regs.frombytes(msg)
+    if not NATIVE_BIG_ENDIAN:
+        regs.byteswap()
+    return regs
+
+
+def registers_to_bytes(regs):
+    # type: (list[int] | array) -> bytes
+    regs = array("H", regs) # also copies, so byteswap leaves the caller's array untouched
+    if not NATIVE_BIG_ENDIAN:
+        regs.byteswap()
+    return regs.tobytes()
+
+
+def registers_from_str(msg, length, encoding="utf-8", tailling=b'\x00'):
+    # type: (str, int, str, bytes) -> array
+    """
+    Encode msg into exactly `length` registers, cut or padded with tailling.
+    """
+    payload = msg.encode(encoding=encoding)[:length * 2]
+    return registers_from_bytes(payload.ljust(length * 2, tailling[:1]))
+
+
+class PayloadCache:
+    def __init__(self, capacity=128):
+        # type: (int) -> None
+        """
+        Size-bounded LRU cache of encoded slot payloads, keyed by (slot length, message, encoding, color).
+
+        # Args
+        - capacity: max number of payloads kept. 0 disables the cache.
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict() # type: OrderedDict[tuple, array]
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # type: (tuple) -> array | None
+        with self.lock:
+            v = self.entries.get(key)
+            if v is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return v
+
+    def put(self, key, value):
+        # type: (tuple, array) -> None
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        # type: () -> dict[str, int]
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self.entries), capacity=self.capacity)
@@ -1,65 +1,478 @@
 import sys
-from collections import namedtuple
+import os
+import signal
+from collections import namedtuple, OrderedDict
 import threading
 import queue
 import multiprocessing as mp
+from contextlib import contextmanager, nullcontext
 import time
+import random
+import copy
+from array import array
 import yaml
 import pymodbus
 from pymodbus.client import ModbusTcpClient
 
+import codec
+import metrics
+import backpressure
+import snapshot
+import pipeline
+
 class ModbusProxier:
-    SlotType = namedtuple("SlotType", ["server", "address", "slave", "length"])
-    def __init__(self, config):
+    SlotType = namedtuple("SlotType", ["server", "address", "slave", "length", "priority", "critical"], defaults=(0, False))
+    MAX_WRITE_REGISTERS = 123 # FC16 quantity limit
+    MAX_READ_REGISTERS = 125 # FC03 quantity limit
+    MAX_READWRITE_REGISTERS = 121 # FC23 write quantity limit
+    CONNECTION_KEYS = ("host", "port", "framer") # a server whose entries here change gets a new client on reload
+    BREAKER_STATES = ("closed", "open", "half-open") # in the order of the breaker_state gauge
+    def __init__(self, config, batching=False, shadow=True):
+        # type: (str | dict, bool, bool) -> None
+        """
+        # Args
+        - config: a config file or an dict containing the config
+        - batching: if True, writes are staged and only sent on `flush()`, merged into the fewest contiguous FC16 requests per server and slave.
+        - shadow: if True, keep a copy of the registers written or read through slots. writes that change nothing are skipped, only the changed span is sent, and reads are answered from the copy unless forced.
+
+        Writes are read back to verify them for slots marked critical, and for a random verify_fraction of the others.
+        Servers with fc23 do that in one FC23 read/write request, others with an FC03 read after the write.
+
+        pymodbus waits for each response before sending the next request. For servers with a pipeline_window above 1, the FC16
+        requests of a flush that are not verified are sent on a second connection instead, up to that many in flight (see pipeline.py);
+        the display must accept two clients then.
+        """
+        self.config_path = config if isinstance(config, str) else None # type: str | None # reloaded by `reload()`
         if isinstance(config, str):
             with open(config, "r") as f:
                 config = yaml.safe_load(f)
         self.config = config
         self.tailing_byte = self.config["tailing_byte"].to_bytes(1, "big") # type: bytes
+        self.timeout = self.config.get("connect_timeout", 1.0) # type: float
+        self.backoff_min = self.config.get("reconnect_backoff_min", 0.5) # type: float
+        self.backoff_max = self.config.get("reconnect_backoff_max", 30.0) # type: float
+        self.down = {} # type: dict[str, tuple[float, float]] # server -> (time of next attempt, current delay): its breaker is open, reconnected in the background
+        self.reconnector = None # type: threading.Thread | None
+        self.breaker_failures = self.config.get("breaker_failures", 3) # type: int # consecutive failed requests that open a server's breaker
+        self.failures = {} # type: dict[str, int] # server -> consecutive failed requests
+        self.probing = set() # type: set[str] # servers whose breaker is half-open: reconnected, the parked state being flushed
+        self.parked = {} # type: dict[tuple[str, int], dict[int, int]] # (server, slave) -> { address: value } written while the breaker was open
+
+        self.clients = { it["name"]: self.create_client(it) for it in self.config["servers"] }
+        self.names = { id(client): name for name, client in self.clients.items() } # type: dict[int, str]
+        self.client_locks = { name: threading.Lock() for name in self.clients } # type: dict[str, threading.Lock] # lanes, pollers and callers share a client
+        self.windows = { it["name"]: it.get("pipeline_window", 1) for it in self.config["servers"] } # type: dict[str, int]
+        self.pipelines = {} # type: dict[str, pipeline.ModbusPipeline] # server -> connection of its pipelined writes, opened on first use
+        self.slots = { it["key"]: ModbusProxier.SlotType(it["server"], it["address"], it["slave"], it["length"], it.get("priority", 0), it.get("critical", False))
+                       for it in self.config["slots"] }
+        self.verify_fraction = self.config.get("verify_fraction", 0.0) # type: float
+        self.fc23 = { it["name"]: it.get("fc23", False) for it in self.config["servers"] } # type: dict[str, bool]
+        self.aging = self.config.get("priority_aging", 1.0) # type: float # seconds of waiting that count as one priority level
+        self.cache = codec.PayloadCache(self.config.get("encode_cache_size", 128))
+        self.metrics = metrics.Metrics()
+        self.requests = {} # type: dict[str, int] # server -> requests sent, the frames lanes count against max_frame_rate
+        for it in self.clients:
+            self.metrics.gauge("breaker_state", lambda name=it: self.BREAKER_STATES.index(self.breaker_state(name)), server=it)
+
+        self.batching = batching
+        self.pending = {} # type: dict[tuple[str, int], dict[int, int]] # (server, slave) -> { address: value }
+        self.lock = threading.RLock()
+
+        self.use_shadow = shadow
+        self.shadow = {} # type: dict[tuple[str, int], dict[int, int]] # (server, slave) -> { address: value } last known on the device
+        self.seen = {} # type: dict[tuple[str, int], dict[int, float]] # (server, slave) -> { address: time.monotonic() the value was last read or written }
+        self.max_age = self.config.get("read_max_age") # type: float | None # reads are served from the shadow only if this fresh. None for any age
+        self.snapshot = None # type: snapshot.ImageSnapshot | None # the shadow persisted to snapshot_path, reloaded at startup
+        self.open_snapshot()
+
+    def reload(self, config=None):
+        # type: (str | dict | None) -> tuple[set[str], set[str], set[str]]
+        """
+        Apply a new config in place. Servers whose host, port or framer changed get a new client once their current request is done,
+        other connections are kept. The slot index and the settings are rebuilt; shadows of new or moved servers are forgotten.
+        Nothing is changed if the new config is invalid.
+
+        # Args
+        - config: a config file or an dict containing the config. defaults to the file the proxier was created from.
+
+        Returns (added, removed, reconnected) server names.
+        """
+        if config is None:
+            config = self.config_path
+        if isinstance(config, str):
+            with open(config, "r") as f:
+                config = yaml.safe_load(f)
+        tailing_byte = config["tailing_byte"].to_bytes(1, "big")
+        old = { it["name"]: it for it in self.config["servers"] }
+        new = { it["name"]: it for it in config["servers"] }
+        slots = { it["key"]: ModbusProxier.SlotType(it["server"], it["address"], it["slave"], it["length"], it.get("priority", 0), it.get("critical", False))
+                  for it in config["slots"] }
+        unknown = sorted(set(it.server for it in slots.values()) - set(new))
+        if unknown:
+            raise ValueError(f"Slots refer to unknown servers {unknown}.")
+
+        added = set(new) - set(old)
+        removed = set(old) - set(new)
+        reconnected = set(it for it in set(new) & set(old) if any(new[it].get(k) != old[it].get(k) for k in self.CONNECTION_KEYS))
+        clients = dict(self.clients)
+        stale = [ (it, clients.pop(it)) for it in removed | reconnected ]
+        for it in added | reconnected:
+            clients[it] = self.create_client(new[it])
 
-        self.clients = { it["name"]: ModbusTcpClient(it["host"],
-                                                     port=it.get("port", 502),
-                                                     framer=it.get("framer", pymodbus.Framer.SOCKET))
-                         for it in self.config["servers"] }
-        self.slots = { it["key"]: ModbusProxier.SlotType(it["server"], it["address"], it["slave"], it["length"]) for it in self.config["slots"] }
+        with self.lock:
+            locks = dict(self.client_locks)
+            if tailing_byte != self.tailing_byte or config.get("encode_cache_size", 128) != self.cache.capacity:
+                self.cache = codec.PayloadCache(config.get("encode_cache_size", 128)) # cached payloads are padded with the old tailing byte
+            self.config = config
+            self.tailing_byte = tailing_byte
+            self.clients = clients
+            self.names = { id(client): name for name, client in clients.items() }
+            self.client_locks = { it: locks.get(it) or threading.Lock() for it in clients }
+            pipelines = self.pipelines
+            self.pipelines = { it: p for it, p in pipelines.items() if it not in removed | reconnected }
+            self.windows = { it["name"]: it.get("pipeline_window", 1) for it in config["servers"] }
+            self.slots = slots
+            self.verify_fraction = config.get("verify_fraction", 0.0)
+            self.fc23 = { it["name"]: it.get("fc23", False) for it in config["servers"] }
+            self.aging = config.get("priority_aging", 1.0)
+            self.max_age = config.get("read_max_age")
+            self.timeout = config.get("connect_timeout", 1.0)
+            self.backoff_min = config.get("reconnect_backoff_min", 0.5)
+            self.backoff_max = config.get("reconnect_backoff_max", 30.0)
+            self.breaker_failures = config.get("breaker_failures", 3)
+            for it in removed | reconnected:
+                self.down.pop(it, None)
+                self.failures.pop(it, None)
+            for it in [ it for it in self.pending if it[0] in removed ]:
+                del self.pending[it]
+            for it in [ it for it in self.parked if it[0] in removed ]:
+                del self.parked[it]
+        for it in added:
+            self.metrics.gauge("breaker_state", lambda name=it: self.BREAKER_STATES.index(self.breaker_state(name)), server=it)
+
+        for name, client in stale:
+            self.retire(name, client, locks.get(name), pipelines.get(name))
+        for it in added | removed | reconnected:
+            self.invalidate(it)
+        self.open_snapshot()
+        return added, removed, reconnected
+
+    def snapshot_layout(self):
+        # type: () -> dict[str, tuple[int, int]]
+        """
+        Returns { "server/slave": (first register, number of registers) } covering the slots of each server and slave.
+        """
+        spans = {} # type: dict[str, tuple[int, int]] # key -> [first, last)
+        for it in self.slots.values():
+            key = f"{it.server}/{it.slave}"
+            lo, hi = spans.get(key, (it.address, it.address + it.length))
+            spans[key] = (min(lo, it.address), max(hi, it.address + it.length))
+        return { key: (lo, hi - lo) for key, (lo, hi) in spans.items() }
+
+    def open_snapshot(self):
+        """
+        Map snapshot_path for the current slots. At startup the shadow is loaded from it (unless older than snapshot_max_age),
+        so the first writes are diffed against what the displays last showed; if the slots changed it starts from the shadow instead.
+        """
+        path = self.config.get("snapshot_path") if self.use_shadow else None
+        layout = self.snapshot_layout()
+        if self.snapshot is not None:
+            if self.snapshot.path == path and self.snapshot.layout == dict(layout):
+                return
+            self.snapshot.close()
+            self.snapshot = None
+        if path is None:
+            return
+        try:
+            image = snapshot.ImageSnapshot(path, layout)
+        except (OSError, ValueError) as e:
+            print(f"Failed to open the snapshot {path} ({e}), the shadow is not persisted.", file=sys.stderr)
+            return
+        with self.lock:
+            if image.fresh:
+                for (server, slave), registers in self.shadow.items():
+                    for address in sorted(registers):
+                        image.update(f"{server}/{slave}", address, [registers[address]])
+            else:
+                for key, registers in image.load(self.config.get("snapshot_max_age")).items():
+                    server, slave = key.rsplit("/", 1)
+                    self.shadow.setdefault((server, int(slave)), {}).update(registers) # not in `seen`: reads still go to the device
+            self.snapshot = image
+
+    def retire(self, name, client, lock, pipe=None):
+        # type: (str, ModbusTcpClient, threading.Lock | None, pipeline.ModbusPipeline | None) -> None
+        """
+        Close a client replaced or removed by `reload()` and the connection of its pipelined writes, after the request they may be in the middle of.
+        """
+        with lock if lock is not None else nullcontext():
+            client.close()
+            if pipe is not None:
+                pipe.close()
+
+    def create_client(self, server):
+        # type: (dict[str]) -> ModbusTcpClient
+        return ModbusTcpClient(server["host"],
+                               port=server.get("port", 502),
+                               framer=server.get("framer", pymodbus.Framer.SOCKET),
+                               timeout=server.get("connect_timeout", self.config.get("connect_timeout", 1.0)))
+
+    def create_pipeline(self, server):
+        # type: (dict[str]) -> pipeline.ModbusPipeline
+        return pipeline.ModbusPipeline(server["host"],
+                                       port=server.get("port", 502),
+                                       timeout=server.get("connect_timeout", self.config.get("connect_timeout", 1.0)))
+
+    def pipeline_for(self, server):
+        # type: (str) -> pipeline.ModbusPipeline
+        with self.lock:
+            ret = self.pipelines.get(server)
+            if ret is None:
+                ret = self.pipelines[server] = self.create_pipeline(next(it for it in self.config["servers"] if it["name"] == server))
+            return ret
 
     def __del__(self):
         for it in self.clients.values():
             if it.connected:
                 it.close()
+        for it in self.pipelines.values():
+            it.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
     
     def connect(self, client):
-        if not client.connect():
+        """
+        Connect a client. A server known to be down fails at once; it is reconnected in the background instead.
+        """
+        name = self.names.get(id(client))
+        if name in self.down:
+            return False
+        ok = client.connect()
+        self.record_connect(client, ok)
+        if not ok:
             print(f"Failed to connect to {client.comm_params.host}:{client.comm_params.port}.", file=sys.stderr)
+            if name is not None:
+                self.mark_down(name)
             return False
         return True
 
+    def connect_all(self, timeout=None):
+        # type: (float | None) -> dict[str, bool]
+        """
+        Connect every server at once, waiting at most timeout (defaults to connect_timeout), and report which are up.
+        The others are reconnected in the background.
+
+        Returns { server: connected }.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        clients = [ (name, client) for name, client in self.clients.items() if not client.connected ]
+        threads = [ threading.Thread(target=self.connect, args=(client,), daemon=True) for _, client in clients ]
+        deadline = time.monotonic() + timeout
+        for it in threads:
+            it.start()
+        for it in threads:
+            it.join(max(deadline - time.monotonic(), 0))
+        ret = { name: client.connected for name, client in self.clients.items() }
+        self.report(ret)
+        return ret
+
+    def report(self, connected):
+        # type: (dict[str, bool]) -> None
+        up = sorted(it for it, ok in connected.items() if ok)
+        down = sorted(it for it, ok in connected.items() if not ok)
+        print(f"Connected to {up}" + (f", {down} down and retried in the background." if down else "."), file=sys.stderr)
+        for it in down:
+            if it not in self.down:
+                self.mark_down(it) # still connecting after the deadline
+
+    def mark_down(self, name):
+        # type: (str) -> None
+        with self.lock:
+            _, delay = self.down.get(name, (0.0, 0.0))
+            delay = min(max(delay * 2, self.backoff_min), self.backoff_max)
+            self.down[name] = (time.monotonic() + delay, delay)
+            if self.reconnector is None:
+                self.reconnector = threading.Thread(target=self.reconnect_loop, daemon=True)
+                self.reconnector.start()
+
+    def reconnect_loop(self):
+        """
+        Retry the servers that are down, each after its backoff delay, until none is left.
+        A server that reconnects is half-open until its parked state is flushed: if that fails too, its breaker opens again.
+        """
+        while True:
+            with self.lock:
+                if not self.down:
+                    self.reconnector = None
+                    return
+                name, (at, _) = min(self.down.items(), key=lambda it: it[1][0])
+            wait = at - time.monotonic()
+            if wait > 0:
+                time.sleep(min(wait, 0.5))
+                continue
+            client = self.clients.get(name)
+            if client is None: # removed by reload()
+                with self.lock:
+                    self.down.pop(name, None)
+                continue
+            if not self.reconnect(client):
+                self.mark_down(name)
+                continue
+            with self.lock:
+                self.probing.add(name)
+            try:
+                ok, sent = self.flush_parked(name)
+            finally:
+                with self.lock:
+                    self.probing.discard(name)
+            if not ok:
+                self.mark_down(name)
+                continue
+            with self.lock:
+                self.down.pop(name, None)
+                self.failures[name] = 0 if sent else self.breaker_failures - 1 # not proven by a write yet, one more failure reopens it
+            print(f"Reconnected to {name}" + (f", flushed {sent} registers." if sent else "."), file=sys.stderr)
+
+    def breaker_state(self, name):
+        # type: (str) -> str
+        """
+        Returns "closed" (writes are sent), "open" (writes are parked, the server is retried after its backoff)
+        or "half-open" (reconnected, the parked state being flushed).
+        """
+        if name in self.probing:
+            return "half-open"
+        if name in self.down:
+            return "open"
+        return "closed"
+
+    def park(self, server, slave, address, values):
+        # type: (str, int, int, list[int] | array) -> None
+        """
+        Keep values to write once the server's breaker closes. A later write to the same register replaces the parked one.
+        """
+        with self.lock:
+            parked = self.parked.setdefault((server, slave), {})
+            for i, n in enumerate(values):
+                parked[address + i] = n
+        self.metrics.inc("parked_total", server=server)
+
+    def record_failure(self, server, slave, address, values):
+        # type: (str, int, int, list[int] | array) -> None
+        """
+        Count a failed write and park its values, so they are sent when the breaker closes again even if it was still closed
+        when they failed. `breaker_failures` in a row open the server's breaker.
+        """
+        self.park(server, slave, address, values)
+        self.count_failure(server)
+
+    def count_failure(self, server):
+        # type: (str) -> None
+        with self.lock:
+            n = self.failures.get(server, 0) + 1
+            self.failures[server] = n
+            trip = n >= self.breaker_failures and server not in self.down
+        if trip:
+            print(f"Breaker of {server} opened after {n} failed requests.", file=sys.stderr)
+            self.mark_down(server)
+
+    def record_success(self, server, slave, address, count):
+        # type: (str, int, int, int) -> None
+        """
+        Reset the server's failure count, and drop the parked values of the registers just written, which are newer.
+        """
+        with self.lock:
+            self.failures[server] = 0
+            parked = self.parked.get((server, slave))
+            if parked:
+                for i in range(address, address + count):
+                    parked.pop(i, None)
+
+    def flush_parked(self, server):
+        # type: (str) -> tuple[bool, int]
+        """
+        Send what the server should show, the last known image overlaid with the parked writes (those that failed before the breaker
+        opened included), coalesced into as few requests as possible.
+        The shadow is forgotten first, as the display may have been power cycled while it was away.
+
+        Returns (all sent, number of registers).
+        """
+        with self.lock:
+            keys = set(it for it in self.shadow if it[0] == server) | set(it for it in self.parked if it[0] == server)
+            images = {}
+            for it in keys:
+                image = dict(self.shadow.get(it, {}))
+                image.update(self.parked.pop(it, {}))
+                images[it] = image
+        self.invalidate(server)
+        ret = True
+        for (_, slave), image in images.items():
+            ret = self.send_pending(server, slave, image) and ret
+        return ret, sum(len(it) for it in images.values())
+
+    def reconnect(self, client):
+        # type: (ModbusTcpClient) -> bool
+        ok = client.connected or client.connect()
+        self.record_connect(client, ok)
+        return ok
+
+    def record_connect(self, client, ok):
+        # type: (ModbusTcpClient, bool) -> None
+        server = self.names.get(id(client), client.comm_params.host)
+        self.metrics.inc("connects_total", server=server)
+        if not ok:
+            self.metrics.inc("connect_errors_total", server=server)
+
+    def record_io(self, server, op, quantity, ok, elapsed):
+        # type: (str, str, int, bool, float) -> None
+        """
+        Record one request to a server. op is "write" (FC16), "read" (FC03) or "readwrite" (FC23), quantity the number of registers.
+        """
+        with self.lock:
+            self.requests[server] = self.requests.get(server, 0) + 1
+        self.metrics.observe("rtt_seconds", elapsed, server=server, op=op)
+        self.metrics.inc(f"{op}s_total", server=server)
+        if not ok:
+            self.metrics.inc(f"{op}_errors_total", server=server)
+            return
+        if op == "write":
+            self.metrics.inc("bytes_sent_total", 13 + quantity * 2, server=server) # MBAP + FC16 header + values
+        elif op == "readwrite":
+            self.metrics.inc("bytes_sent_total", 17 + quantity * 2, server=server) # MBAP + FC23 header + values
+        if op != "write":
+            self.metrics.inc("bytes_received_total", 9 + quantity * 2, server=server) # MBAP + FC03 / FC23 header + values
+
 
     def write_str(self, slot, msg, color, encoding="utf-8"):
         # type: (str, str, int, str) -> bool
+        v = self.encode_str(slot, msg, color, encoding)
+        if v is None:
+            return False
+        return self.write_registers(slot, v)
+
+    def encode_str(self, slot, msg, color, encoding="utf-8"):
+        # type: (str, str, int | None, str) -> list[int]
+        """
+        Encode msg into the registers of the slot, padded with tailing_byte and followed by color.
+        If color is None, the color register is left out.
+        """
         if slot not in self.slots:
             print(f"Slot {slot} not found.", file=sys.stderr)
-            return False
+            return None
         s = self.slots[slot]
-        v = self.registers_from_str(msg, encoding, tailling=self.tailing_byte)
-        if len(v) > s.length - 1:
-            v = v[:s.length - 1]
-        elif len(v) < s.length - 1:
-            v.extend([int.from_bytes(self.tailing_byte * 2, byteorder="big")] * (s.length - 1 - len(v)))
-        v.append(color)
-        return self.write_registers(slot, v)
+        key = (s.length, msg, encoding, color)
+        v = self.cache.get(key)
+        if v is None:
+            with self.metrics.timer("encode_seconds"):
+                v = codec.registers_from_str(msg, s.length - 1, encoding, tailling=self.tailing_byte)
+                if color is not None:
+                    v.append(color)
+            self.cache.put(key, v)
+        return v[:] # the cached payload stays untouched
 
     def write_str_without_color(self, slot, msg, encoding="utf-8"):
         # type: (str, str, str) -> bool
-        if slot not in self.slots:
-            print(f"Slot {slot} not found.", file=sys.stderr)
+        v = self.encode_str(slot, msg, None, encoding)
+        if v is None:
             return False
-        s = self.slots[slot]
-        v = self.registers_from_str(msg, encoding, tailling=self.tailing_byte)
-        if len(v) > s.length - 1:
-            v = v[:s.length - 1]
-        elif len(v) < s.length - 1:
-            v.extend([int.from_bytes(self.tailing_byte * 2, byteorder="big")] * (s.length - 1 - len(v)))
         return self.write_registers(slot, v)
 
     def write_color(self, slot, color):
@@ -75,28 +488,338 @@ class ModbusProxier:
 
     def write_registers(self, slot, values, offset=0):
         # type: (str, list[int] | int, int) -> bool
+        if self.batching:
+            return self.stage_registers(slot, values, offset)
         if slot not in self.slots:
             print(f"Slot {slot} not found.", file=sys.stderr)
             return False
         s = self.slots[slot]
-        client = self.clients[s.server]
-        v = values.copy()
+        v = [values] if isinstance(values, int) else values[:]
         if offset < 0:
             offset = s.length + offset
         full_length = s.length - offset
         if len(v) > full_length:
             v = v[:full_length]
-        self.write_registers_raw(client, s.address + offset, v, s.slave)
+        return self.write_image(s.server, s.slave, s.address + offset, v)
+
+    def stage_registers(self, slot, values, offset=0):
+        # type: (str, list[int] | int, int) -> bool
+        """
+        Stage a write for the next `flush()` instead of sending it. A later stage to the same register replaces the earlier one.
+        """
+        if slot not in self.slots:
+            print(f"Slot {slot} not found.", file=sys.stderr)
+            return False
+        s = self.slots[slot]
+        v = [values] if isinstance(values, int) else values
+        if offset < 0:
+            offset = s.length + offset
+        full_length = s.length - offset
+        if len(v) > full_length:
+            v = v[:full_length]
+        with self.lock:
+            pending = self.pending.setdefault((s.server, s.slave), {})
+            for i, n in enumerate(v):
+                pending[s.address + offset + i] = n
+        return True
+
+    def flush(self, server=None):
+        # type: (str | None) -> bool
+        """
+        Send the staged writes, each contiguous register range as one FC16 request of at most MAX_WRITE_REGISTERS registers.
+
+        # Args
+        - server: only flush the writes bound for this server. if None, flush all.
+        """
+        with self.lock:
+            keys = [ it for it in self.pending if server is None or it[0] == server ]
+            batches = [ (it, self.pending.pop(it)) for it in keys ]
+
+        ret = True
+        for (name, slave), pending in batches:
+            ret = self.send_pending(name, slave, pending) and ret
+        return ret
+
+    def send_pending(self, server, slave, pending):
+        # type: (str, int, dict[int, int]) -> bool
+        requests = self.order_requests(server, slave, self.coalesce(pending, self.MAX_WRITE_REGISTERS))
+        if self.windows.get(server, 1) > 1 and len(requests) > 1:
+            return self.write_pipelined(server, slave, requests)
+        ret = True
+        for address, values in requests:
+            ret = self.write_image(server, slave, address, values) and ret
+        return ret
+
+    def write_pipelined(self, server, slave, requests):
+        # type: (str, int, list[tuple[int, list[int] | array]]) -> bool
+        """
+        Write requests in order, up to the server's pipeline_window in flight on the connection of its pipelined writes.
+        Those to be verified go through `write_image` first, one round trip at a time.
+        """
+        plain = self.split_pipelined(server, slave, requests)
+        if plain is None:
+            return False
+        ret = True
+        for address, values, verify in plain:
+            if verify:
+                ret = self.write_image(server, slave, address, values, verify=True) and ret
+        plain = [ (address, values) for address, values, verify in plain if not verify ]
+        if not plain:
+            return ret
+        if self.breaker_state(server) == "open": # opened by a verified write above
+            for address, values in plain:
+                self.park(server, slave, address, values)
+            return False
+        with self.client_locks[server]:
+            results = self.pipeline_for(server).write_many(slave, plain, self.windows.get(server, 1))
+        return self.record_pipelined(server, slave, plain, results) and ret
+
+    def split_pipelined(self, server, slave, requests):
+        # type: (str, int, list[tuple[int, list[int] | array]]) -> list[tuple[int, list[int] | array, bool]] | None
+        """
+        Returns (address, values, verify) of the requests trimmed to what differs from the shadow, or None if they were parked as the breaker is open.
+        """
+        if self.breaker_state(server) == "open":
+            for address, values in requests:
+                self.park(server, slave, address, values)
+            return None
+        ret = []
+        for address, values in requests:
+            diff = self.diff_image(server, slave, address, values)
+            if diff is not None:
+                ret.append(diff + (self.should_verify(server, slave, diff[0], len(diff[1])),))
+        return ret
+
+    def record_pipelined(self, server, slave, requests, results):
+        # type: (str, int, list[tuple[int, list[int] | array]], list[float | bool | None]) -> bool
+        """
+        Account for pipelined requests as `write_image` does for one, results being what `ModbusPipeline.write_many` returned.
+        A failed batch counts as one failure, like one failed pymodbus request; the requests it did not get through are parked.
+        """
+        ret = True
+        for (address, values), result in zip(requests, results):
+            if result is not None:
+                self.record_io(server, "write", len(values), result is not False, result or 0.0)
+            if result is None or result is False:
+                self.park(server, slave, address, values)
+                ret = False
+                continue
+            self.record_success(server, slave, address, len(values))
+            self.update_image(server, slave, address, values)
+        if not ret:
+            self.count_failure(server)
+        return ret
+
+    def order_requests(self, server, slave, requests):
+        # type: (str, int, list[tuple[int, list[int]]]) -> list[tuple[int, list[int]]]
+        """
+        Sort coalesced (address, values) requests so the one covering the highest priority slot goes out first.
+        """
+        if len(requests) < 2:
+            return requests
+        slots = [ it for it in self.slots.values() if it.server == server and it.slave == slave ]
+        def priority(request):
+            address, values = request
+            return max([ it.priority for it in slots if it.address < address + len(values) and address < it.address + it.length ], default=0)
+        return sorted(requests, key=priority, reverse=True)
+
+    def by_priority(self, since, now=None):
+        # type: (dict[str, float], float | None) -> list[str]
+        """
+        Order pending slots for sending: highest priority first, where every `priority_aging` seconds a slot has been waiting
+        counts as one more level, so low priority slots are not starved by a steady stream of urgent ones. Ties go to the oldest.
+
+        # Args
+        - since: { slot: time.monotonic() when it became pending }. slots no longer configured, e.g. during a reload, are left out.
+        """
+        now = time.monotonic() if now is None else now
+        slots = self.slots # reload() may swap it meanwhile
+        def key(slot):
+            waited = now - since[slot]
+            aged = waited / self.aging if self.aging > 0 else 0
+            return (-(slots[slot].priority + aged), since[slot])
+        return sorted((it for it in since if it in slots), key=key)
+
+    def write_many(self, updates, encoding="utf-8"):
+        # type: (list[tuple[str, str, int]], str) -> dict[str, bool]
+        """
+        Write several (slot, msg, color) at once. The updates of each server are sent together as coalesced requests,
+        apart from anything staged by other callers, and succeed or fail together.
+
+        Returns { slot: success }.
+        """
+        ret, servers = self.encode_many(updates, encoding)
+        for name, writes in servers.items():
+            if self.batching:
+                ok = all([ self.stage_registers(slot, v) for slot, v in writes ])
+            else:
+                ok = all([ self.send_pending(name, slave, it) for slave, it in self.merge_writes(writes).items() ])
+            ret.update((slot, ok) for slot, _ in writes)
+        return ret
+
+    def encode_many(self, updates, encoding="utf-8"):
+        # type: (list[tuple[str, str, int]], str) -> tuple[dict[str, bool], OrderedDict[str, list[tuple[str, array]]]]
+        """
+        Returns ({ slot: False } for the slots that failed to encode, { server: [(slot, registers), ...] }).
+        """
+        ret = {}
+        servers = OrderedDict()
+        for slot, msg, color in updates:
+            v = self.encode_str(slot, msg, color, encoding)
+            if v is None:
+                ret[slot] = False
+                continue
+            servers.setdefault(self.slots[slot].server, []).append((slot, v))
+        return ret, servers
+
+    def merge_writes(self, writes):
+        # type: (list[tuple[str, array]]) -> dict[int, dict[int, int]]
+        """
+        Returns { slave: { address: value } } of whole-slot writes, later writes winning.
+        """
+        pending = {}
+        for slot, v in writes:
+            s = self.slots[slot]
+            image = pending.setdefault(s.slave, {})
+            for i, n in enumerate(v[:s.length]):
+                image[s.address + i] = n
+        return pending
+
+    def write_image(self, server, slave, address, values, verify=None):
+        # type: (str, int, int, list[int] | array, bool | None) -> bool
+        """
+        Write values at address unless the shadow says they are already on the device. Only the changed span is sent.
+        While the server's breaker is open the values are parked instead, and False is returned.
+
+        - verify: read the values back. if None, decided by `should_verify`.
+        """
+        if self.breaker_state(server) == "open":
+            self.park(server, slave, address, values)
+            return False
+        diff = self.diff_image(server, slave, address, values)
+        if diff is None:
+            return True
+        address, values = diff
+        verify = self.should_verify(server, slave, address, len(values)) if verify is None else verify
+        actual = None
+        with self.client_locks[server]:
+            client = self.clients[server] # looked up under the lock, as reload() may replace it
+            t = time.perf_counter()
+            if verify and self.fc23[server] and len(values) <= self.MAX_READWRITE_REGISTERS:
+                actual = self.readwrite_registers_raw(client, address, values, slave)
+                ok = actual is not None
+                self.record_io(server, "readwrite", len(values), ok, time.perf_counter() - t)
+            else:
+                ok = self.write_registers_raw(client, address, values, slave)
+                self.record_io(server, "write", len(values), ok, time.perf_counter() - t)
+                if ok and verify:
+                    t = time.perf_counter()
+                    actual = self.read_holding_registers_raw(client, address, len(values), slave)
+                    self.record_io(server, "read", len(values), actual is not None, time.perf_counter() - t)
+        if not ok:
+            self.record_failure(server, slave, address, values)
+            return False
+        self.record_success(server, slave, address, len(values))
+        if verify:
+            return self.check_readback(server, slave, address, values, actual)
+        self.update_image(server, slave, address, values)
+        return True
+
+    def should_verify(self, server, slave, address, count):
+        # type: (str, int, int, int) -> bool
+        if self.verify_fraction > 0 and random.random() < self.verify_fraction:
+            return True
+        return any(it.critical for it in self.slots.values()
+                   if it.server == server and it.slave == slave and it.address < address + count and address < it.address + it.length)
+
+    def check_readback(self, server, slave, address, values, actual):
+        # type: (str, int, int, list[int] | array, list[int] | None) -> bool
+        """
+        Compare what was written with what the device holds after the write, and keep the latter in the shadow, so a register
+        that did not take is written again next time. Returns False on a mismatch.
+        """
+        if actual is None:
+            # the write itself was acknowledged
+            print(f"Failed to read back registers {address}..{address + len(values) - 1} of {server}.", file=sys.stderr)
+            self.metrics.inc("verify_errors_total", server=server)
+            self.update_image(server, slave, address, values)
+            return True
+        self.metrics.inc("verified_total", server=server)
+        self.update_image(server, slave, address, actual)
+        if list(actual) != list(values):
+            wrong = [ address + i for i, (a, b) in enumerate(zip(actual, values)) if a != b ]
+            print(f"Read back registers {wrong} of {server} differ from what was written.", file=sys.stderr)
+            self.metrics.inc("verify_mismatches_total", server=server)
+            return False
+        return True
+
+    def diff_image(self, server, slave, address, values):
+        # type: (str, int, int, list[int]) -> tuple[int, list[int]] | None
+        """
+        Returns (address, values) trimmed to the span between the first and last register that differs from the shadow, or None if nothing differs.
+        """
+        if not self.use_shadow:
+            return address, values
+        with self.lock:
+            image = self.shadow.get((server, slave), {})
+            changed = [ i for i, n in enumerate(values) if image.get(address + i) != n ]
+        if not changed:
+            return None
+        return address + changed[0], values[changed[0]:changed[-1] + 1]
+
+    def update_image(self, server, slave, address, values):
+        # type: (str, int, int, list[int]) -> None
+        if not self.use_shadow:
+            return
+        now = time.monotonic()
+        with self.lock:
+            image = self.shadow.setdefault((server, slave), {})
+            seen = self.seen.setdefault((server, slave), {})
+            for i, n in enumerate(values):
+                image[address + i] = n
+                seen[address + i] = now
+            if self.snapshot is not None:
+                self.snapshot.update(f"{server}/{slave}", address, values)
+
+    def invalidate(self, server=None):
+        # type: (str | None) -> None
+        """
+        Forget the shadow of the server (e.g. after the display was power cycled), so the next writes are sent in full. if None, forget all.
+        """
+        with self.lock:
+            for it in [ it for it in self.shadow if server is None or it[0] == server ]:
+                del self.shadow[it]
+                self.seen.pop(it, None)
+            if self.snapshot is not None:
+                for it in self.snapshot.layout:
+                    if server is None or it.rsplit("/", 1)[0] == server:
+                        self.snapshot.forget(it)
+
+    @contextmanager
+    def batch(self):
+        """
+        Stage every write in the `with` block and flush them on exit.
+        """
+        batching = self.batching
+        self.batching = True
+        try:
+            yield self
+        finally:
+            self.batching = batching
+            self.flush()
 
     def write_registers_raw(self, client, address, values, slave):
         # type: (ModbusTcpClient, int, list[int] | int, int) -> bool
         if not client.connected:
             if not self.connect(client): return False
+        if isinstance(values, array):
+            values = values.tolist() # pymodbus only takes a list or a single int
 
         try:
             rr = client.write_registers(address, values, slave=slave)
         except pymodbus.ModbusException as e:
             print(f"Received ModbusException({e})", file=sys.stderr)
+            return False
 
         if rr.isError():
             print(f"Received Modbus library error({rr})", file=sys.stderr)
@@ -104,6 +827,27 @@ class ModbusProxier:
 
         return True
     
+    def readwrite_registers_raw(self, client, address, values, slave):
+        # type: (ModbusTcpClient, int, list[int] | array, int) -> list[int] | None
+        """
+        Write values and read the same registers back in one FC23 request. Returns the registers read, or None on error.
+        """
+        if not client.connected:
+            if not self.connect(client): return None
+        if isinstance(values, array):
+            values = values.tolist()
+        try:
+            rr = client.readwrite_registers(read_address=address, read_count=len(values), write_address=address, values=values, slave=slave)
+        except pymodbus.ModbusException as e:
+            print(f"Received ModbusException({e})", file=sys.stderr)
+            return None
+
+        if rr.isError():
+            print(f"Received Modbus library error({rr})", file=sys.stderr)
+            return None
+
+        return rr.registers
+
     def read_holding_registers_raw(self, client, address, count, slave):
         # type: (ModbusTcpClient, int, int, int) -> list[int]
         if not client.connected:
@@ -112,6 +856,7 @@ class ModbusProxier:
             rr = client.read_holding_registers(address, count, slave)
         except pymodbus.ModbusException as e:
             print(f"Received ModbusException({e})", file=sys.stderr)
+            return None
 
         if rr.isError():
             print(f"Received Modbus library error({rr})", file=sys.stderr)
@@ -119,77 +864,300 @@ class ModbusProxier:
 
         return rr.registers
 
-    def read_holding_registers(self, slot, count=None, offset=0):
-        # type: (str, int, int) -> list[int]
+    def read_holding_registers(self, slot, count=None, offset=0, force=False, max_age=None):
+        # type: (str, int, int, bool, float | None) -> list[int]
+        """
+        - force: read from the device even if the shadow knows every register.
+        - max_age: serve from the shadow only if every register was read or written within this many seconds. defaults to read_max_age.
+        """
         if slot not in self.slots:
             print(f"Slot {slot} not found.", file=sys.stderr)
             return None
         s = self.slots[slot]
-        client = self.clients[s.server]
         if offset < 0:
             offset = s.length + offset
         if count is None or count < 0 or count > s.length:
             count = s.length
         if count > s.length - offset:
             count = s.length - offset
-        return self.read_holding_registers_raw(client, s.address + offset, count, s.slave)
+        if not force:
+            ret = self.read_image(s.server, s.slave, s.address + offset, count, self.max_age if max_age is None else max_age)
+            if ret is not None:
+                return ret
+        return self.read_block(s.server, s.slave, s.address + offset, count)
 
-    def read_str(self, slot, count=None, encoding="utf-8"):
-        # type: (str, int | None, str) -> str
+    def read_block(self, server, slave, address, count):
+        # type: (str, int, int, int) -> list[int] | None
+        """
+        Read count registers from the device in one FC03 request and keep them in the shadow.
+        """
+        with self.client_locks[server]:
+            t = time.perf_counter()
+            ret = self.read_holding_registers_raw(self.clients[server], address, count, slave)
+            self.record_io(server, "read", count, ret is not None, time.perf_counter() - t)
+        if ret is not None:
+            self.update_image(server, slave, address, ret)
+        return ret
+
+    def read_image(self, server, slave, address, count, max_age=None):
+        # type: (str, int, int, int, float | None) -> list[int] | None
+        """
+        Returns the registers from the shadow, or None if any of them is unknown or, with max_age, older than max_age seconds.
+        Registers not read or written since startup are unknown, even if the shadow was loaded from the snapshot.
+        """
+        if not self.use_shadow:
+            return None
+        oldest = None if max_age is None else time.monotonic() - max_age
+        with self.lock:
+            image = self.shadow.get((server, slave), {})
+            seen = self.seen.get((server, slave), {})
+            try:
+                times = [ seen[address + i] for i in range(count) ]
+                if oldest is not None and any(it < oldest for it in times):
+                    return None
+                return [ image[address + i] for i in range(count) ]
+            except KeyError:
+                return None
+
+    def read_blocks(self, max_gap=0):
+        # type: (int) -> list[tuple[str, int, int, int]]
+        """
+        Group the slots into the fewest (server, slave, address, count) FC03 reads of at most MAX_READ_REGISTERS registers.
+        Slots up to max_gap registers apart share a read, the gap being read too.
+        """
+        ret = []
+        for it in sorted(self.slots.values(), key=lambda it: (it.server, it.slave, it.address)):
+            if ret:
+                server, slave, address, count = ret[-1]
+                end = max(address + count, it.address + it.length)
+                if (server, slave) == (it.server, it.slave) and it.address <= address + count + max_gap and end - address <= self.MAX_READ_REGISTERS:
+                    ret[-1] = (server, slave, address, end - address)
+                    continue
+            ret.append((it.server, it.slave, it.address, it.length))
+        return ret
+
+    def read_str(self, slot, count=None, encoding="utf-8", force=False, max_age=None):
+        # type: (str, int | None, str, bool, float | None) -> str
         if slot not in self.slots:
             print(f"Slot {slot} not found.", file=sys.stderr)
             return None
         s = self.slots[slot]
         if count is None or count < 0 or count > s.length - 1:
             count = s.length - 1
-        ret = self.read_holding_registers(slot, count)
+        ret = self.read_holding_registers(slot, count, force=force, max_age=max_age)
         if ret is not None:
             ret = self.registers_to_str(ret, encoding)
         return ret
 
-    def read_color(self, slot):
-        # type: (str) -> int
-        ret = self.read_holding_registers(slot, 1, -1)
+    def read_color(self, slot, force=False, max_age=None):
+        # type: (str, bool, float | None) -> int
+        ret = self.read_holding_registers(slot, 1, -1, force=force, max_age=max_age)
         ret = ret[0] if ret is not None else 0
         return ret
     
+    @classmethod
+    def coalesce(cls, registers, limit):
+        # type: (dict[int, int], int) -> list[tuple[int, list[int]]]
+        """
+        Split { address: value } into (start address, values) runs of contiguous registers, each at most `limit` long.
+        """
+        runs = []
+        for address in sorted(registers):
+            if runs and runs[-1][0] + len(runs[-1][1]) == address and len(runs[-1][1]) < limit:
+                runs[-1][1].append(registers[address])
+            else:
+                runs.append((address, [registers[address]]))
+        return runs
+
     @classmethod
     def registers_from_bytes(cls, msg, tailling=b'\x00'):
-        # type: (bytes, bytes) -> list[int]
-        payload = []
-        payload_bin = msg
-        if (len(payload_bin) % 2 == 1):
-            payload_bin = payload_bin + tailling[:1]
-        for i in range(len(payload_bin)//2):
-            payload.append(int.from_bytes(bytes(payload_bin[i*2:i*2+2]), byteorder="big"))
-        return payload
-    
+        # type: (bytes | bytearray | memoryview, bytes) -> array
+        return codec.registers_from_bytes(msg, tailling=tailling)
+
     @classmethod
     def registers_to_bytes(cls, regs):
-        # type: (list[int]) -> bytes
-        payload = []
-        for it in regs:
-            payload.extend(list(it.to_bytes(2, byteorder="big")))
-        return bytes(payload)
-    
+        # type: (list[int] | array) -> bytes
+        return codec.registers_to_bytes(regs)
+
     @classmethod
     def registers_from_str(cls, msg, encoding="utf-8", tailling=b'\x00'):
-        # type: (str, str, bytes) -> list[int]
-        return cls.registers_from_bytes(msg.encode(encoding=encoding), tailling=tailling)
-    
+        # type: (str, str, bytes) -> array
+        return codec.registers_from_bytes(msg.encode(encoding=encoding), tailling=tailling)
+
     @classmethod
     def registers_to_str(cls, regs, encoding="utf-8"):
-        # type: (list[int], str) -> str
-        return cls.registers_to_bytes(regs).decode(encoding)
+        # type: (list[int] | array, str) -> str
+        return codec.registers_to_bytes(regs).decode(encoding)
+
+class ModbusLane(threading.Thread):
+    def __init__(self, proxier, server, max_frame_rate=None, max_batch=None):
+        # type: (ModbusProxier, str, float | None, int | None) -> None
+        """
+        Worker owning all writes to one server, so a slow or unreachable server only delays its own lane.
+
+        # Args
+        - proxier: the ModbusProxier shared by all lanes
+        - server: server name
+        - max_frame_rate: max requests per second to the server. updates arriving in between are collected and sent together on the
+          next tick. a flush of n requests (runs of registers apart, reads to verify, reads by pollers meanwhile) puts the next tick
+          n intervals later. None for no limit.
+        - max_batch: max slots sent per flush, picked by `ModbusProxier.by_priority`; the rest wait for the next tick. None for no limit.
+        """
+        super(ModbusLane, self).__init__(daemon=True)
+        self.proxier = proxier
+        self.server = server
+        self.interval = 1.0 / max_frame_rate if max_frame_rate else 0.0
+        self.next_flush = 0.0 # time.monotonic() of the next tick
+        self.cond = threading.Condition()
+        self.pending = OrderedDict() # type: OrderedDict[str, dict[str]] # slot -> latest message not sent yet
+        self.collapsed = 0 # number of updates dropped because a newer one for the same slot arrived before sending
+        self.since = {} # type: dict[str, float] # slot -> time.monotonic() when it became pending
+        self.max_batch = max_batch
+        self.running = True
+
+    def put(self, msg):
+        # type: (dict[str]) -> None
+        self.put_many([msg])
+
+    def configure(self, max_frame_rate=None, max_batch=None):
+        # type: (float | None, int | None) -> None
+        with self.cond:
+            self.interval = 1.0 / max_frame_rate if max_frame_rate else 0.0
+            self.max_batch = max_batch
+            self.next_flush = min(self.next_flush, time.monotonic() + self.interval)
+            self.cond.notify()
+
+    def evict(self):
+        # type: () -> list[dict[str]]
+        """
+        Remove and return the pending messages whose slot no longer belongs to this lane's server, e.g. after a reload.
+        """
+        with self.cond:
+            slots = [ it for it in self.pending if it not in self.proxier.slots or self.proxier.slots[it].server != self.server ]
+            for it in slots:
+                self.since.pop(it, None)
+            self.cond.notify()
+            return [ self.pending.pop(it) for it in slots ]
+
+    def take(self):
+        # type: () -> list[dict[str]]
+        """
+        Remove and return the pending messages to send in this flush, highest priority first. Call with the lock held.
+        Slots removed or moved to another server by a reload in progress stay pending until `evict()` hands them over.
+        """
+        slots = self.proxier.slots
+        mine = { it: t for it, t in self.since.items() if it in slots and slots[it].server == self.server }
+        slots = self.proxier.by_priority(mine)[:self.max_batch]
+        for it in slots:
+            del self.since[it]
+        return [ self.pending.pop(it) for it in slots ]
+
+    def put_many(self, msgs):
+        # type: (list[dict[str]]) -> None
+        """
+        Add messages to the pending table at once, so they go out in the same flush.
+        """
+        with self.cond:
+            for msg in msgs:
+                if msg["slot"] in self.pending:
+                    self.collapsed += 1
+                    self.proxier.metrics.inc("collapsed_total", server=self.server)
+                else:
+                    self.since[msg["slot"]] = time.monotonic()
+                self.pending[msg["slot"]] = msg
+            self.cond.notify()
+
+    def process_one(self, block=True, timeout=None):
+        # type: (bool, float | None) -> bool
+        """
+        Wait for pending messages and the next tick, then send the latest one of each slot in one flush.
+        """
+        with self.cond:
+            if block:
+                self.cond.wait_for(lambda: self.pending or not self.running, timeout)
+            if not self.pending:
+                return False
+            delay = self.next_flush - time.monotonic()
+            while delay > 0 and self.running:
+                self.cond.wait(delay) # keep collecting until the tick
+                delay = self.next_flush - time.monotonic()
+            msgs = self.take()
+            if not msgs:
+                self.cond.wait(self.proxier.timeout) # only slots a reload is handing over, until evict()
+                return False
+            self.next_flush = time.monotonic() + self.interval
+
+        self.proxier.metrics.observe_age("queue_wait_seconds", msgs, server=self.server)
+        sent = self.proxier.requests.get(self.server, 0)
+        ret = self.proxier.write_many([ (it["slot"], it["msg"], it["color"]) for it in msgs ], encoding="gb2312")
+        sent = self.proxier.requests.get(self.server, 0) - sent
+        if sent > 1:
+            with self.cond:
+                self.next_flush += self.interval * (sent - 1) # every request is a frame to the display
+        self.proxier.metrics.observe_age("update_latency_seconds", msgs, server=self.server)
+        return all(ret.values())
+
+    def run(self):
+        while self.running:
+            try:
+                self.process_one()
+            except Exception as e:
+                print(f"Lane of {self.server} failed to send ({e!r}), carrying on.", file=sys.stderr)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+
+class ModbusPoller(threading.Thread):
+    def __init__(self, proxier, interval=None, max_gap=0):
+        # type: (ModbusProxier, float | None, int) -> None
+        """
+        Reads every slot in a few block reads per server on a fixed interval, keeping the shadow fresh so read_* are answered
+        locally within read_max_age. Needs the proxier's shadow.
+
+        # Args
+        - proxier: the ModbusProxier whose shadow is kept fresh
+        - interval: seconds between polls. defaults to poll_interval, or 1.0.
+        - max_gap: slots up to this many registers apart are read in one request, the gap included.
+        """
+        super(ModbusPoller, self).__init__(daemon=True)
+        self.proxier = proxier
+        self.interval = interval if interval is not None else proxier.config.get("poll_interval", 1.0)
+        self.max_gap = max_gap
+        self.stopped = threading.Event()
+
+    def poll_once(self):
+        # type: () -> bool
+        ret = True
+        for server, slave, address, count in self.proxier.read_blocks(self.max_gap): # follows the slots across reloads
+            ret = self.proxier.read_block(server, slave, address, count) is not None and ret
+        return ret
+
+    def run(self):
+        while not self.stopped.is_set():
+            t = time.monotonic()
+            self.poll_once()
+            self.stopped.wait(max(self.interval - (time.monotonic() - t), 0))
+
+    def stop(self):
+        self.stopped.set()
+
 
 class ModbusDispatcher(threading.Thread):
-    def __init__(self, proxier, capacity=50, q=None):
-        # type: (ModbusProxier | str | dict, int, None | mp.Queue) -> None
+    def __init__(self, proxier, capacity=50, q=None, policy=None):
+        # type: (ModbusProxier | str | dict, int, None | mp.Queue, str | None) -> None
         """
         # Args
         - proxier: an instance of ModbusProxier or a config file or an dict containing the config
         - capacity: capacity of the queue. ignored if q is not None.
-        - q: multiprocessing.Queue[dict[str]] with { "slot": slot, "msg": msg, "color": color } inside, where slot: int, msg: str, color: int. if None, mp.Queue will be created automatically.
+        - q: multiprocessing.Queue[dict[str]] with { "slot": slot, "msg": msg, "color": color, "t": t } inside, where slot: int, msg: str, color: int,
+             or { "updates": [ { "slot": slot, "msg": msg, "color": color, "t": t }, ... ] } for a batch. if None, mp.Queue will be created automatically.
+             a shm_queue.ShmQueue can be passed instead of an mp.Queue.
+             t is time.time() when the update was made, set by `metrics.stamp(update)`. updates without it are left out of
+             queue_wait_seconds and update_latency_seconds.
+        - policy: what push does when the queue is full, one of backpressure.POLICIES. defaults to overflow_policy, else "block".
         """
         super(ModbusDispatcher, self).__init__()
 
@@ -205,35 +1173,198 @@ class ModbusDispatcher(threading.Thread):
         else:
             self.proxier = ModbusProxier(proxier)
 
+        self.policy = policy or self.proxier.config.get("overflow_policy", "block") # type: str
+        if self.policy not in backpressure.POLICIES:
+            raise ValueError(f"Unknown overflow policy {self.policy}, expected one of {backpressure.POLICIES}.")
+
+        self.lanes = { it["name"]: ModbusLane(self.proxier, it["name"], it.get("max_frame_rate"), it.get("max_batch"))
+                       for it in self.proxier.config["servers"] } # type: dict[str, ModbusLane]
+
+        self.proxier.metrics.gauge("queue_depth", self.queue.qsize)
+        for name, it in self.lanes.items():
+            self.proxier.metrics.gauge("pending_slots", lambda it=it: len(it.pending), server=name)
+
+        self.running = False
+        self.reload_requested = False
+        self.check_interval = self.proxier.config.get("reload_check_interval", 1.0) # type: float # seconds between checks of the config file
+        self.next_check = time.monotonic() + self.check_interval
+        self.config_mtime = self.config_changed_at()
+
+    def config_changed_at(self):
+        # type: () -> float | None
+        if self.proxier.config_path is None:
+            return None
+        try:
+            return os.stat(self.proxier.config_path).st_mtime
+        except OSError:
+            return None
+
+    def request_reload(self, *args):
+        """
+        Ask the dispatcher to reload its config file on its next check, e.g. from a SIGHUP handler.
+        """
+        self.reload_requested = True
+
+    def check_reload(self):
+        # type: () -> bool
+        """
+        Reload if requested or if the config file changed since the last check. Checks at most every reload_check_interval.
+        """
+        if not self.reload_requested and time.monotonic() < self.next_check:
+            return False
+        self.next_check = time.monotonic() + self.check_interval
+        mtime = self.config_changed_at()
+        if not self.reload_requested and mtime == self.config_mtime:
+            return False
+        self.config_mtime = mtime
+        self.reload_requested = False
+        return self.reload()
+
+    def reload(self, config=None):
+        # type: (str | dict | None) -> bool
+        """
+        Reload the config (defaults to the proxier's config file) while messages keep flowing: only changed servers are
+        reconnected, lanes are added, reconfigured or stopped, and pending messages of moved slots follow them to their new lane.
+        """
+        try:
+            added, removed, reconnected = self.proxier.reload(config)
+        except Exception as e:
+            print(f"Failed to reload the config ({e}), keeping the old one.", file=sys.stderr)
+            return False
+        self.check_interval = self.proxier.config.get("reload_check_interval", 1.0)
+        policy = self.proxier.config.get("overflow_policy", self.policy)
+        if policy in backpressure.POLICIES:
+            self.policy = policy
+        else:
+            print(f"Unknown overflow policy {policy}, keeping {self.policy}.", file=sys.stderr)
+
+        orphans = []
+        for name in removed:
+            lane = self.lanes.pop(name)
+            lane.stop()
+            orphans += lane.evict()
+        for it in self.proxier.config["servers"]:
+            if it["name"] in self.lanes:
+                self.lanes[it["name"]].configure(it.get("max_frame_rate"), it.get("max_batch"))
+                continue
+            lane = ModbusLane(self.proxier, it["name"], it.get("max_frame_rate"), it.get("max_batch"))
+            self.lanes[it["name"]] = lane
+            self.proxier.metrics.gauge("pending_slots", lambda lane=lane: len(lane.pending), server=it["name"])
+            if self.running:
+                lane.start()
+        for lane in list(self.lanes.values()):
+            orphans += lane.evict()
+        for it in orphans:
+            self.route(it)
+        print(f"Reloaded the config: added {sorted(added)}, removed {sorted(removed)}, reconnected {sorted(reconnected)}.", file=sys.stderr)
+        return True
+
+    @property
+    def collapsed(self):
+        # type: () -> int
+        return sum(it.collapsed for it in self.lanes.values())
+
     def push(self, slot, msg, color, block=True, timeout=None):
         # type: (str, str, int, bool, float | None) -> bool
         """
         # Args
         - slot: slot name
         - msg: message string
+        - block, timeout: how long to wait if the queue is full, for the "block" policy. others never wait.
+
+        Returns False if the update was dropped.
         """
         if slot not in self.proxier.slots:
             print(f"Slot {slot} not found.", file=sys.stderr)
             return False
+        return self.offer(dict(slot=slot, msg=msg, color=color, t=time.time()), block, timeout)
+
+    def offer(self, item, block=True, timeout=None):
+        # type: (dict[str], bool, float | None) -> bool
         try:
-            self.queue.put(dict(slot=slot, msg=msg, color=color), block=block, timeout=timeout)
-            return True
-        except:
+            return backpressure.offer(self.queue, item, self.proxier.metrics, self.policy, backpressure.capacity_of(self.queue, self.capacity), block, timeout)
+        except Exception as e:
+            print(f"Received Exception while enqueing ({e})", file=sys.stderr)
             return False
 
+    def push_many(self, updates, block=True, timeout=None):
+        # type: (list[tuple[str, str, int]], bool, float | None) -> dict[str, bool]
+        """
+        Push several (slot, msg, color) as one queue item. They reach each server's lane together and are sent in the same flush.
+
+        Returns { slot: accepted }.
+        """
+        ret = {}
+        batch = []
+        for slot, msg, color in updates:
+            if slot not in self.proxier.slots:
+                print(f"Slot {slot} not found.", file=sys.stderr)
+                ret[slot] = False
+                continue
+            batch.append(dict(slot=slot, msg=msg, color=color, t=time.time()))
+        ok = self.offer(dict(updates=batch), block, timeout) if batch else False
+        for it in batch:
+            ret[it["slot"]] = ok
+        return ret
+
+    def route(self, msg):
+        # type: (dict[str]) -> bool
+        """
+        Hand a message (or a batch) to the lane of its slot's server. Never blocks on the lane.
+        """
+        lanes = OrderedDict() # type: OrderedDict[str, list[dict[str]]]
+        ret = True
+        for it in msg.get("updates", [msg]):
+            if it["slot"] not in self.proxier.slots:
+                print(f"Slot {it['slot']} not found.", file=sys.stderr)
+                ret = False
+                continue
+            lanes.setdefault(self.proxier.slots[it["slot"]].server, []).append(it)
+        for server, msgs in lanes.items():
+            self.lanes[server].put_many(msgs)
+        return ret
+
     def process_one(self, block=True, timeout=None):
         # type: (bool, float | None) -> bool
+        """
+        Process queued messages in the calling thread, without the lane workers.
+        Wait for one message, then take whatever else is already queued (up to capacity) so only the latest message per slot is sent.
+        """
         try:
             msg = self.queue.get(block, timeout)
         except:
             return False
-        return self.proxier.write_str(msg["slot"], msg["msg"], msg["color"], encoding="gb2312")
+        self.route(msg)
+        for _ in range(self.capacity - 1):
+            try:
+                msg = self.queue.get(block=False)
+            except queue.Empty:
+                break
+            self.route(msg)
+        ret = True
+        for it in self.lanes.values():
+            if it.pending:
+                ret = it.process_one(block=False) and ret
+        self.check_reload()
+        return ret
 
     def run(self):
         self.running = True
+        if self.proxier.config.get("metrics_port"):
+            self.proxier.metrics.serve(self.proxier.config["metrics_port"])
+        self.proxier.connect_all()
+        for it in self.lanes.values():
+            it.start()
         while self.running:
             if not self.running: break
-            self.process_one()
+            self.check_reload()
+            try:
+                msg = self.queue.get(timeout=self.check_interval) # wake up now and then to check the config
+            except:
+                continue
+            self.route(msg)
+        for it in self.lanes.values():
+            it.stop()
 
     def stop(self):
         self.running = False
@@ -241,6 +1372,8 @@ class ModbusDispatcher(threading.Thread):
 
 def dispatch_modbus(q):
     dispatcher = ModbusDispatcher("modbus-dispatcher.yaml", q=q)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, dispatcher.request_reload) # `kill -HUP` reloads modbus-dispatcher.yaml
     dispatcher.run()
 
 
@@ -316,6 +1449,72 @@ def assert_data(data, i):
     ]
     assert bytes(data) == datas[i]
 
+def test_simulated():
+    """
+    Breaker and reload checks against simulated displays, which can be switched off and on.
+    """
+    import simulator
+    with open("modbus-dispatcher.yaml", "r") as f:
+        config = yaml.safe_load(f)
+    config["reconnect_backoff_min"] = 0.1
+    with simulator.Simulator.for_config(config) as sim:
+        proxier = ModbusProxier(sim.config_for(config))
+        proxier.connect_all()
+        s = proxier.slots[3]
+        assert proxier.write_str(3, "没有检车项目", 1, encoding="gb2312")
+        assert sim[s.server].text(s.slave, s.address, s.length - 1) == "没有检车项目"
+
+        # writes to a display that is off are parked, also those failing before its breaker opens, then flushed once it is back
+        sim[s.server].stop()
+        assert not proxier.write_str(3, "无项目", 2, encoding="gb2312")
+        assert proxier.breaker_state(s.server) == "closed" # breaker_failures defaults to 3
+        for _ in range(proxier.breaker_failures):
+            if proxier.breaker_state(s.server) == "open":
+                break
+            assert not proxier.write_str(1, "625", 1, encoding="gb2312")
+        assert proxier.breaker_state(s.server) == "open"
+        assert proxier.parked[(s.server, s.slave)][s.address + s.length - 1] == 2
+        display = sim.restart(s.server)
+        deadline = time.monotonic() + 5
+        while proxier.breaker_state(s.server) != "closed" and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert proxier.breaker_state(s.server) == "closed"
+        assert display.text(s.slave, s.address, s.length - 1) == "无项目"
+        assert display.read(s.slave, s.address + s.length - 1, 1) == [2]
+        assert display.text(proxier.slots[1].slave, proxier.slots[1].address, proxier.slots[1].length - 1) == "625"
+
+        # a pending message follows its slot to the server it moved to
+        dispatcher = ModbusDispatcher(proxier, q=queue.Queue(50))
+        dispatcher.route(dict(slot=3, msg="AB", color=1))
+        assert 3 in dispatcher.lanes[s.server].pending
+        moved = copy.deepcopy(proxier.config)
+        other = next(it["name"] for it in moved["servers"] if it["name"] != s.server)
+        for it in moved["slots"]:
+            if it["key"] == 3:
+                it["server"] = other
+        assert dispatcher.reload(moved)
+        assert 3 not in dispatcher.lanes[s.server].pending and 3 in dispatcher.lanes[other].pending
+        assert dispatcher.lanes[other].process_one(block=False)
+        assert sim[other].text(s.slave, s.address, s.length - 1) == "AB"
+        assert display.text(s.slave, s.address, s.length - 1) == "无项目"
+
+        # a pipelined flush gets over dropped connections by reconnecting once, without counting a failure
+        config = copy.deepcopy(proxier.config)
+        for it in config["servers"]:
+            it["pipeline_window"] = 4
+        proxier = ModbusProxier(config)
+        proxier.connect_all()
+        keys = (4, 6, 8) # apart, so one request each
+        server = proxier.slots[keys[0]].server
+        assert all(proxier.write_many([ (it, "AB", 1) for it in keys ], encoding="gb2312").values())
+        assert server in proxier.pipelines
+        sim[server].disconnect()
+        assert all(proxier.write_many([ (it, "CD", 2) for it in keys ], encoding="gb2312").values())
+        assert proxier.breaker_state(server) == "closed" and proxier.failures[server] == 0
+        for it in keys:
+            t = proxier.slots[it]
+            assert sim[server].text(t.slave, t.address, t.length - 1) == "CD"
+
 def main():
     q = mp.Queue(50)
     subproc = mp.Process(target=dispatch_modbus, args=(q,))
@@ -324,19 +1523,19 @@ def main():
     init_data = proxier.registers_from_bytes(bytes.fromhex("31 35 20 20 20 20 00 02 D5 FD D4 DA BC EC B3 B5 00 02 20 20 20 20 B3 B5 C1 BE D5 FD D4 DA BC EC B2 E2 A3 AC C7 EB D2 C0 B4 CE B4 F2 BF AA B3 B5 B5 C6 20 20 20 20 20 20 20 20 00 02 D3 D0 00 02 D3 D0 00 02 D3 D0 00 02 D3 D0 00 02 D7 F3 C1 C1 20 20 00 02 D3 D2 C1 C1 20 20 00 02 32 30 20 20 20 20 00 02 D7 F3 B2 BB C1 C1 00 01 D3 D2 B2 BB C1 C1 00 01 B2 BB C9 C1 CB B8 00 01 D7 F3 C1 C1 20 20 00 02 D3 D2 B2 BB C1 C1 00 01 C1 C1 C6 F0 20 20 00 02"), tailling=b'\x20')
     proxier.write_registers_raw(proxier.clients[proxier.slots[3].server], 0, init_data,1)
     
-    q.put(dict(slot=3, msg="没有检车项目", color=1))
+    q.put(metrics.stamp(dict(slot=3, msg="没有检车项目", color=1)))
     time.sleep(1)
     assert_data(proxier.registers_to_bytes(proxier.read_holding_registers_raw(proxier.clients[proxier.slots[3].server], 0, 74, 1)), 0)
-    q.put(dict(slot=1, msg="625", color=1))
+    q.put(metrics.stamp(dict(slot=1, msg="625", color=1)))
     time.sleep(1)
     assert_data(proxier.registers_to_bytes(proxier.read_holding_registers_raw(proxier.clients[proxier.slots[1].server], 0, 74, 1)), 1)
-    q.put(dict(slot=2, msg="无项目", color=1))
+    q.put(metrics.stamp(dict(slot=2, msg="无项目", color=1)))
     time.sleep(1)
     assert_data(proxier.registers_to_bytes(proxier.read_holding_registers_raw(proxier.clients[proxier.slots[2].server], 0, 74, 1)), 2)
-    q.put(dict(slot=4, msg="AB", color=1))
+    q.put(metrics.stamp(dict(slot=4, msg="AB", color=1)))
     time.sleep(1)
     assert_data(proxier.registers_to_bytes(proxier.read_holding_registers_raw(proxier.clients[proxier.slots[4].server], 0, 74, 1)), 3)
-    q.put(dict(slot=15, msg="0123", color=2))
+    q.put(metrics.stamp(dict(slot=15, msg="0123", color=2)))
     time.sleep(1)
     assert_data(proxier.registers_to_bytes(proxier.read_holding_registers_raw(proxier.clients[proxier.slots[15].server], 0, 74, 1)), 4)
 
@@ -345,6 +1544,8 @@ def main():
     assert proxier.read_str(3, encoding="gb2312").strip() == "没有检车项目"
     assert proxier.read_color(3)==1
 
+    test_simulated()
+
     print("All test passed.")
 
     subproc.kill()
@@ -1,15 +1,28 @@
 import sys
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import threading
 import queue
 import multiprocessing as mp
 import time
 import yaml
 import socket
+import select
+import struct
+from array import array
+
+import codec
+import metrics
+import backpressure
+import snapshot
+import pipeline
 
 class LEDProxier:
     SlotType = namedtuple("SlotType", ["server", "address", "slave", "length"])
-    ServerType = namedtuple("ServerType", ["host", "port"])
+    ServerType = namedtuple("ServerType", ["host", "port", "partial", "window"])
+    HEADER = pipeline.REQUEST # MBAP (transaction, protocol, length, unit) + FC16 (function, address, quantity, byte count)
+    MAX_WRITE_REGISTERS = 123 # FC16 quantity limit
+    BREAKER_STATES = ("closed", "open", "half-open") # in the order of the breaker_state gauge
+    DEFAULT_IMAGE = bytes.fromhex("31 35 20 20 20 20 00 02 D5 FD D4 DA BC EC B3 B5 00 02 20 20 20 20 B3 B5 C1 BE D5 FD D4 DA BC EC B2 E2 A3 AC C7 EB D2 C0 B4 CE B4 F2 BF AA B3 B5 B5 C6 20 20 20 20 20 20 20 20 00 02 D3 D0 00 02 D3 D0 00 02 D3 D0 00 02 D3 D0 00 02 D7 F3 C1 C1 20 20 00 02 D3 D2 C1 C1 20 20 00 02 32 30 20 20 20 20 00 02 D7 F3 B2 BB C1 C1 00 01 D3 D2 B2 BB C1 C1 00 01 B2 BB C9 C1 CB B8 00 01 D7 F3 C1 C1 20 20 00 02 D3 D2 B2 BB C1 C1 00 01 C1 C1 C6 F0 20 20 00 02") # from address 0
     def __init__(self, config):
         if isinstance(config, str):
             with open(config, "r") as f:
@@ -17,46 +30,279 @@ class LEDProxier:
         self.config = config
         self.tailing_byte = self.config["tailing_byte"].to_bytes(1, "big") # type: bytes
         
-        self.servers = { it["name"]: LEDProxier.ServerType(it["host"], it["port"])
+        self.servers = { it["name"]: LEDProxier.ServerType(it["host"], it["port"], it.get("partial_frames", False), it.get("pipeline_window", 0))
                          for it in self.config["servers"] }
         self.slots = { it["key"]: LEDProxier.SlotType(it["server"], it["address"], it["slave"], it["length"]) for it in self.config["slots"] }
-        self.header_bin = bytes.fromhex("00 01 00 00 00 9B 01 10 00 00 00 4A 94")
-        self.data = list(bytes.fromhex("31 35 20 20 20 20 00 02 D5 FD D4 DA BC EC B3 B5 00 02 20 20 20 20 B3 B5 C1 BE D5 FD D4 DA BC EC B2 E2 A3 AC C7 EB D2 C0 B4 CE B4 F2 BF AA B3 B5 B5 C6 20 20 20 20 20 20 20 20 00 02 D3 D0 00 02 D3 D0 00 02 D3 D0 00 02 D3 D0 00 02 D7 F3 C1 C1 20 20 00 02 D3 D2 C1 C1 20 20 00 02 32 30 20 20 20 20 00 02 D7 F3 B2 BB C1 C1 00 01 D3 D2 B2 BB C1 C1 00 01 B2 BB C9 C1 CB B8 00 01 D7 F3 C1 C1 20 20 00 02 D3 D2 B2 BB C1 C1 00 01 C1 C1 C6 F0 20 20 00 02"))
+        self.cache = codec.PayloadCache(self.config.get("encode_cache_size", 128))
+        self.metrics = metrics.Metrics() # labelled by host:port, as the servers are keyed by address
+        self.timeout = self.config.get("connect_timeout", 1.0) # type: float # the longest a write may block, in seconds
+        self.backoff_min = self.config.get("reconnect_backoff_min", 0.5) # type: float
+        self.backoff_max = self.config.get("reconnect_backoff_max", 30.0) # type: float
+        self.sockets = {} # type: dict[LEDProxier.ServerType, socket.socket]
+        self.snapshot = None # type: snapshot.ImageSnapshot | None # what each server was last sent, persisted to snapshot_path
+        self.backoff = {} # type: dict[LEDProxier.ServerType, tuple[float, float]] # server -> (time of next attempt, current delay): its breaker is open
+        self.breaker_failures = self.config.get("breaker_failures", 3) # type: int # consecutive failed frames that open a server's breaker
+        self.failures = {} # type: dict[LEDProxier.ServerType, int] # server -> consecutive failed frames
+        self.slaves = { self.servers[it.server]: it.slave for it in self.slots.values() } # type: dict[LEDProxier.ServerType, int] # for frames sent on recovery
+        # servers with pipeline_window keep up to that many frames in flight, each with its own transaction id
+        self.transaction = 0 # last transaction id used
+        self.inflight = {} # type: dict[LEDProxier.ServerType, OrderedDict[int, tuple[float, int, int]]] # server -> { transaction: (time sent, first, last register of the image) }
+        self.received = {} # type: dict[LEDProxier.ServerType, bytearray] # server -> bytes of responses not parsed yet
+
+        # the image covers every slot, so a full frame rewrites the whole display
+        self.base = min(it.address for it in self.slots.values()) # type: int
+        self.quantity = max(it.address + it.length for it in self.slots.values()) - self.base # type: int
+        if self.quantity > self.MAX_WRITE_REGISTERS:
+            raise ValueError(f"Slots span {self.quantity} registers, more than {self.MAX_WRITE_REGISTERS} fit in one frame.")
+        self.spans = {} # type: dict[LEDProxier.ServerType, list[tuple[int, int]]] # server -> [first, last) registers of the image its slots cover
+        for it in self.slots.values():
+            self.spans.setdefault(self.servers[it.server], []).append((it.address - self.base, it.address - self.base + it.length))
+        image = bytearray(self.tailing_byte * (self.quantity * 2))
+        default = self.DEFAULT_IMAGE[self.base * 2 : (self.base + self.quantity) * 2]
+        image[:len(default)] = default
+
+        # header and image share one buffer, updated in place and sent as is
+        self.frame = bytearray(self.HEADER.size) + image
+        self.view = memoryview(self.frame)
+        self.header_bin = self.view[:self.HEADER.size]
+        self.data = self.view[self.HEADER.size:]
+        self.pack_header(self.header_bin, 1, self.base, self.quantity)
+        # scratch buffer for partial frames
+        self.delta = bytearray(len(self.frame))
+        self.delta_view = memoryview(self.delta)
+        self.dirty = {} # type: dict[LEDProxier.ServerType, tuple[int, int]] # server -> [first, last) register of the image not sent to it yet
+        if self.config.get("snapshot_path"):
+            self.load_snapshot(self.config["snapshot_path"])
+        for it in self.servers.values():
+            self.metrics.gauge("breaker_state", lambda server=it: self.BREAKER_STATES.index(self.breaker_state(server)), server=self.label(it))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for it in self.sockets.values():
+            it.close()
+        self.sockets.clear()
+        if self.snapshot is not None:
+            self.snapshot.flush()
+
+    def load_snapshot(self, path):
+        # type: (str) -> None
+        """
+        Resume the image from what the servers were last sent instead of DEFAULT_IMAGE (unless older than snapshot_max_age).
+        A server that was last sent something else gets those registers marked dirty, so its first frame catches it up.
+        """
+        try:
+            self.snapshot = snapshot.ImageSnapshot(path, { self.label(it): (self.base, self.quantity) for it in self.servers.values() })
+        except (OSError, ValueError) as e:
+            print(f"Failed to open the snapshot {path} ({e}), the image is not persisted.", file=sys.stderr)
+            return
+        shown = self.snapshot.load(self.config.get("snapshot_max_age"))
+        for registers in shown.values():
+            for address, value in registers.items():
+                self.data[(address - self.base) * 2 : (address - self.base + 1) * 2] = value.to_bytes(2, "big")
+        for server in self.servers.values():
+            registers = shown.get(self.label(server), {})
+            for address, value in registers.items():
+                i = address - self.base
+                if self.data[i * 2 : i * 2 + 2] != value.to_bytes(2, "big"):
+                    self.mark_dirty(server, i, i + 1)
+
+    def connect(self, server, deadline=None):
+        # type: (LEDProxier.ServerType, float | None) -> socket.socket | None
+        """
+        Returns the connection to the server, reusing it while it is alive.
+        After a failed attempt, reconnecting is skipped until the backoff delay (doubling up to reconnect_backoff_max) has passed.
 
-    def connect(self, s, server):
-        # type: (socket.socket, LEDProxier.ServerType) -> bool
+        - deadline: time.monotonic() by which connecting must give up. defaults to connect_timeout from now.
+        """
+        s = self.sockets.get(server)
+        if s is not None:
+            if self.receive(server, s) if server.window else self.alive(s):
+                return s
+            self.disconnect(server)
+
+        now = time.monotonic()
+        next_attempt, delay = self.backoff.get(server, (0.0, 0.0))
+        if now < next_attempt:
+            return None
+        if deadline is None:
+            deadline = now + self.timeout
+        if deadline <= now:
+            return None
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(deadline - now)
+        self.metrics.inc("connects_total", server=self.label(server))
         try:
             s.connect((server.host, server.port))
-            return True
         except socket.error as e:
-            print(f"Received Exception when connecting ({e})", file=sys.stderr)
+            s.close()
+            self.metrics.inc("connect_errors_total", server=self.label(server))
+            delay = self.open_breaker(server)
+            print(f"Received Exception when connecting ({e}), retry in {delay:.1f}s", file=sys.stderr)
+            return None
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.backoff.pop(server, None)
+        self.sockets[server] = s
+        return s
+
+    def open_breaker(self, server):
+        # type: (LEDProxier.ServerType) -> float
+        """
+        Stop sending to the server for the backoff delay, doubling up to reconnect_backoff_max. Returns the delay.
+        """
+        _, delay = self.backoff.get(server, (0.0, 0.0))
+        delay = min(max(delay * 2, self.backoff_min), self.backoff_max)
+        self.backoff[server] = (time.monotonic() + delay, delay)
+        return delay
+
+    def breaker_state(self, server):
+        # type: (LEDProxier.ServerType) -> str
+        """
+        Returns "closed" (frames are sent), "open" (updates only go into the image, which keeps the latest value of every register)
+        or "half-open" (the backoff has passed, the next frame decides).
+        """
+        if server not in self.backoff:
+            return "closed"
+        return "open" if time.monotonic() < self.backoff[server][0] else "half-open"
+
+    def flush_parked(self):
+        # type: () -> bool
+        """
+        Send one frame to each server with registers parked while its breaker was open, once the breaker lets a try through.
+        Returns False if any of them failed.
+        """
+        ret = True
+        for server in [ it for it in self.dirty if self.breaker_state(it) == "half-open" ]:
+            ret = self.send_frame(server, self.slaves.get(server, 1)) and ret
+        return ret
+
+    def retry_time(self):
+        # type: () -> float | None
+        """
+        Time until the earliest breaker with parked registers lets a try through, or None if there is none.
+        """
+        times = [ self.backoff[it][0] for it in self.dirty if it in self.backoff ]
+        if not times:
+            return None
+        return max(min(times) - time.monotonic(), 0.0)
+
+    @classmethod
+    def label(cls, server):
+        # type: (LEDProxier.ServerType) -> str
+        return f"{server.host}:{server.port}"
+
+    def disconnect(self, server):
+        # type: (LEDProxier.ServerType) -> None
+        s = self.sockets.pop(server, None)
+        if s is not None:
+            s.close()
+        # frames still in flight may not have been applied, so their registers are sent again
+        for _, first, last in self.inflight.pop(server, {}).values():
+            self.metrics.inc("write_errors_total", server=self.label(server))
+            self.mark_dirty(server, first, last)
+        self.received.pop(server, None)
+
+    def next_transaction(self):
+        # type: () -> int
+        self.transaction = self.transaction % 0xFFFF + 1
+        return self.transaction
+
+    def receive(self, server, s, timeout=0):
+        # type: (LEDProxier.ServerType, socket.socket, float) -> bool
+        """
+        Read the responses that arrived (waiting up to timeout for the first) and match them to the frames in flight.
+        Returns False if the connection is closed.
+        """
+        buf = self.received.setdefault(server, bytearray())
+        try:
+            ready = select.select([s], [], [], timeout)[0]
+            while ready:
+                chunk = s.recv(4096)
+                if not chunk:
+                    return False # closed by peer
+                buf += chunk
+                self.metrics.inc("bytes_received_total", len(chunk), server=self.label(server))
+                ready = select.select([s], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+        inflight = self.inflight.get(server, {})
+        for transaction, function in pipeline.parse_responses(buf):
+            sent = inflight.pop(transaction, None)
+            if sent is None:
+                continue # not ours, or sent before a reconnect
+            self.metrics.observe("rtt_seconds", time.perf_counter() - sent[0], server=self.label(server), op="write")
+            if function & 0x80:
+                print(f"Received Modbus exception response to transaction {transaction}", file=sys.stderr)
+                self.metrics.inc("write_errors_total", server=self.label(server))
+                self.mark_dirty(server, sent[1], sent[2])
+        return True
+
+    def drain(self, timeout=None):
+        # type: (float | None) -> bool
+        """
+        Wait for the responses to every frame in flight. Returns False if some did not come within timeout (defaults to connect_timeout).
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        for server, inflight in list(self.inflight.items()):
+            s = self.sockets.get(server)
+            while inflight and s is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if not self.receive(server, s, remaining):
+                    self.disconnect(server)
+                    break
+        return not any(self.inflight.values())
+
+    @classmethod
+    def alive(cls, s):
+        # type: (socket.socket) -> bool
+        """
+        Check a connection without blocking. Whatever the display sent back (responses we do not wait for) is discarded.
+        """
+        try:
+            while select.select([s], [], [], 0)[0]:
+                if not s.recv(4096):
+                    return False # closed by peer
+        except (OSError, ValueError):
             return False
+        return True
 
     def write_str(self, slot, msg, color, encoding="utf-8"):
         # type: (str, str, int, str) -> bool
+        v = self.encode_str(slot, msg, color, encoding)
+        if v is None:
+            return False
+        return self.write_registers(slot, v)
+
+    def encode_str(self, slot, msg, color, encoding="utf-8"):
+        # type: (str, str, int | None, str) -> array
+        """
+        Encode msg into the registers of the slot, padded with tailing_byte and followed by color.
+        If color is None, the color register is left out.
+        """
         if slot not in self.slots:
             print(f"Slot {slot} not found.", file=sys.stderr)
-            return False
+            return None
         s = self.slots[slot]
-        v = self.registers_from_str(msg, encoding, tailling=self.tailing_byte)
-        if len(v) > s.length - 1:
-            v = v[:s.length - 1]
-        elif len(v) < s.length - 1:
-            v.extend([int.from_bytes(self.tailing_byte * 2, byteorder="big")] * (s.length - 1 - len(v)))
-        v.append(color)
-        return self.write_registers(slot, v)
+        key = (s.length, msg, encoding, color)
+        v = self.cache.get(key)
+        if v is None:
+            with self.metrics.timer("encode_seconds"):
+                v = codec.registers_from_str(msg, s.length - 1, encoding, tailling=self.tailing_byte)
+                if color is not None:
+                    v.append(color)
+            self.cache.put(key, v)
+        return v[:] # the cached payload stays untouched
 
     def write_str_without_color(self, slot, msg, encoding="utf-8"):
         # type: (str, str, str) -> bool
-        if slot not in self.slots:
-            print(f"Slot {slot} not found.", file=sys.stderr)
+        v = self.encode_str(slot, msg, None, encoding)
+        if v is None:
             return False
-        s = self.slots[slot]
-        v = self.registers_from_str(msg, encoding, tailling=self.tailing_byte)
-        if len(v) > s.length - 1:
-            v = v[:s.length - 1]
-        elif len(v) < s.length - 1:
-            v.extend([int.from_bytes(self.tailing_byte * 2, byteorder="big")] * (s.length - 1 - len(v)))
         return self.write_registers(slot, v)
 
     def write_color(self, slot, color):
@@ -77,71 +323,174 @@ class LEDProxier:
             return False
         s = self.slots[slot]
         server_info = self.servers[s.server]
-        v = values.copy()
+        v = [values] if isinstance(values, int) else values[:]
         if offset < 0:
             offset = s.length + offset
         full_length = s.length - offset
         if len(v) > full_length:
             v = v[:full_length]
-        self.write_registers_raw(server_info, s.address + offset, v, s.slave)
+        return self.write_registers_raw(server_info, s.address + offset, v, s.slave)
 
     def write_registers_raw(self, server_info, address, values, slave):
-        # type: (LEDProxier.ServerType, int, list[int] | int, int) -> bool
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if not self.connect(s, server_info):
-            print("Connection failed.", file=sys.stderr)
+        # type: (LEDProxier.ServerType, int, list[int] | array, int) -> bool
+        """
+        Update the image and send it to the server: the whole image, or for a server with partial_frames only the registers changed since its last frame.
+        """
+        if not self.update_image(address, values):
             return False
+        return self.send_frame(server_info, slave)
 
-        try:
-            for i, n in enumerate(values):
-                self.data[(address + i) * 2 : (address + i) * 2 + 2] = n.to_bytes(2, byteorder="big")
-            rr = s.send(self.header_bin)
-            rr = s.send(bytes(self.data))
-        except Exception as e:
-            print(f"Received Exception when writing registers ({e})", file=sys.stderr)
+    def write_many(self, updates, encoding="utf-8"):
+        # type: (list[tuple[str, str, int]], str) -> dict[str, bool]
+        """
+        Write several (slot, msg, color) at once: the image is updated for all of them, then each server gets one frame.
+
+        Returns { slot: success }.
+        """
+        ret = {}
+        servers = OrderedDict() # type: OrderedDict[str, list[tuple[str, int]]] # server -> [(slot, slave)]
+        for slot, msg, color in updates:
+            v = self.encode_str(slot, msg, color, encoding)
+            if v is None:
+                ret[slot] = False
+                continue
+            s = self.slots[slot]
+            if not self.update_image(s.address, v[:s.length]):
+                ret[slot] = False
+                continue
+            servers.setdefault(s.server, []).append((slot, s.slave))
+        for name, writes in servers.items():
+            ok = self.send_frame(self.servers[name], writes[-1][1])
+            ret.update((slot, ok) for slot, _ in writes)
+        return ret
+
+    def update_image(self, address, values):
+        # type: (int, list[int] | array) -> bool
+        first = address - self.base
+        last = first + len(values)
+        if first < 0 or last > self.quantity:
+            print(f"Registers {address}..{address + len(values) - 1} out of the image.", file=sys.stderr)
             return False
+        self.data[first * 2 : last * 2] = codec.registers_to_bytes(values)
+        # only the servers showing those registers need them, so the dirty range of the others does not grow
+        for server, spans in self.spans.items():
+            for lo, hi in spans:
+                if lo < last and first < hi:
+                    self.mark_dirty(server, max(first, lo), min(last, hi))
+        return True
 
-        s.close()
+    def mark_dirty(self, server, first, last):
+        # type: (LEDProxier.ServerType, int, int) -> None
+        lo, hi = self.dirty.get(server, (first, last))
+        self.dirty[server] = (min(lo, first), max(hi, last))
 
-        return True
+    def send_frame(self, server_info, slave):
+        # type: (LEDProxier.ServerType, int) -> bool
+        if server_info.partial and server_info not in self.dirty:
+            return True # nothing changed since its last frame
+
+        label = self.label(server_info)
+        if self.breaker_state(server_info) == "open":
+            self.metrics.inc("parked_total", server=label) # stays dirty, sent by flush_parked() once the breaker half-opens
+            return False
+        recovering = server_info in self.backoff
+        self.metrics.inc("writes_total", server=label)
+        deadline = time.monotonic() + self.timeout
+        for _ in range(2): # a connection broken since the last write gets one fresh retry
+            s = self.connect(server_info, deadline)
+            if s is None:
+                print("Connection failed.", file=sys.stderr)
+                break
+            try:
+                if server_info.window:
+                    # wait for a free slot in the window; responses may mark more registers dirty
+                    while len(self.inflight.get(server_info, {})) >= server_info.window:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise socket.timeout("no response within connect_timeout")
+                        if not self.receive(server_info, s, remaining):
+                            raise ConnectionError("connection closed by peer")
+                frame, lo, hi = self.build_frame(server_info, slave)
+                if server_info.window:
+                    transaction = self.next_transaction()
+                    struct.pack_into(">H", frame, 0, transaction)
+                s.settimeout(max(deadline - time.monotonic(), 0.001))
+                t = time.perf_counter()
+                s.sendall(frame)
+                if server_info.window:
+                    self.inflight.setdefault(server_info, OrderedDict())[transaction] = (t, lo, hi)
+                else:
+                    self.metrics.observe("rtt_seconds", time.perf_counter() - t, server=label, op="write") # the display is not waited for, so this is the send time
+                self.metrics.inc("bytes_sent_total", len(frame), server=label)
+                if self.snapshot is not None:
+                    self.snapshot.update_bytes(label, self.base + lo, self.data[lo * 2 : hi * 2])
+                self.dirty.pop(server_info, None)
+                self.failures.pop(server_info, None)
+                if recovering:
+                    print(f"Reconnected to {label}, sent registers {lo}..{hi - 1} of the image.", file=sys.stderr)
+                return True
+            except Exception as e:
+                print(f"Received Exception when writing registers ({e})", file=sys.stderr)
+                self.disconnect(server_info)
+        self.metrics.inc("write_errors_total", server=label)
+        self.failures[server_info] = self.failures.get(server_info, 0) + 1
+        if server_info not in self.backoff and (recovering or self.failures[server_info] >= self.breaker_failures): # a failed try reopens it
+            print(f"Breaker of {label} opened after {self.failures[server_info]} failed frames.", file=sys.stderr)
+            self.open_breaker(server_info)
+        return False
+
+    def build_frame(self, server_info, slave):
+        # type: (LEDProxier.ServerType, int) -> tuple[memoryview | bytearray, int, int]
+        """
+        Returns (frame, first, last register of the image it carries): the registers dirty for a server with partial_frames, else the whole image.
+        """
+        if server_info.partial:
+            lo, hi = self.dirty.get(server_info, (0, 0))
+            n = self.HEADER.size + (hi - lo) * 2
+            self.pack_header(self.delta_view, slave, self.base + lo, hi - lo)
+            self.delta_view[self.HEADER.size:n] = self.data[lo * 2 : hi * 2]
+            return self.delta_view[:n], lo, hi
+        self.pack_header(self.header_bin, slave, self.base, self.quantity)
+        return self.frame, 0, self.quantity
     
+    @classmethod
+    def pack_header(cls, buffer, slave, address, quantity):
+        # type: (memoryview, int, int, int) -> None
+        cls.HEADER.pack_into(buffer, 0, 1, 0, 7 + quantity * 2, slave, 0x10, address, quantity, quantity * 2)
+
     @classmethod
     def registers_from_bytes(cls, msg, tailling=b'\x00'):
-        # type: (bytes, bytes) -> list[int]
-        payload = []
-        payload_bin = msg
-        if (len(payload_bin) % 2 == 1):
-            payload_bin = payload_bin + tailling[:1]
-        for i in range(len(payload_bin)//2):
-            payload.append(int.from_bytes(bytes(payload_bin[i*2:i*2+2]), byteorder="big"))
-        return payload
-    
+        # type: (bytes | bytearray | memoryview, bytes) -> array
+        return codec.registers_from_bytes(msg, tailling=tailling)
+
     @classmethod
     def registers_to_bytes(cls, regs):
-        # type: (list[int]) -> bytes
-        payload = []
-        for it in regs:
-            payload.extend(list(it.to_bytes(2, byteorder="big")))
-        return bytes(payload)
-    
+        # type: (list[int] | array) -> bytes
+        return codec.registers_to_bytes(regs)
+
     @classmethod
     def registers_from_str(cls, msg, encoding="utf-8", tailling=b'\x00'):
-        # type: (str, str, bytes) -> list[int]
-        return cls.registers_from_bytes(msg.encode(encoding=encoding), tailling=tailling)
-    
+        # type: (str, str, bytes) -> array
+        return codec.registers_from_bytes(msg.encode(encoding=encoding), tailling=tailling)
+
     @classmethod
     def registers_to_str(cls, regs, encoding="utf-8"):
-        # type: (list[int], str) -> str
-        return cls.registers_to_bytes(regs).decode(encoding)
+        # type: (list[int] | array, str) -> str
+        return codec.registers_to_bytes(regs).decode(encoding)
 
 class ModbusDispatcher(threading.Thread):
-    def __init__(self, proxier, capacity=50, q=None):
-        # type: (LEDProxier | str | dict, int, None | mp.Queue) -> None
+    def __init__(self, proxier, capacity=50, q=None, policy=None):
+        # type: (LEDProxier | str | dict, int, None | mp.Queue, str | None) -> None
         """
         # Args
         - proxier: an instance of LEDProxier or a config file or an dict containing the config
         - capacity: capacity of the queue. ignored if q is not None.
-        - q: multiprocessing.Queue[dict[str]] with { "slot": slot, "msg": msg, "color": color } inside, where slot: int, msg: str, color: int. if None, mp.Queue will be created automatically.
+        - q: multiprocessing.Queue[dict[str]] with { "slot": slot, "msg": msg, "color": color, "t": t } inside, where slot: int, msg: str, color: int,
+             or { "updates": [ { "slot": slot, "msg": msg, "color": color, "t": t }, ... ] } for a batch. if None, mp.Queue will be created automatically.
+             a shm_queue.ShmQueue can be passed instead of an mp.Queue.
+             t is time.time() when the update was made, set by `metrics.stamp(update)`. updates without it are left out of
+             queue_wait_seconds and update_latency_seconds.
+        - policy: what push does when the queue is full, one of backpressure.POLICIES. defaults to overflow_policy, else "block".
         """
         super(ModbusDispatcher, self).__init__()
 
@@ -157,37 +506,131 @@ class ModbusDispatcher(threading.Thread):
         else:
             self.proxier = LEDProxier(proxier)
 
+        self.policy = policy or self.proxier.config.get("overflow_policy", "block") # type: str
+        if self.policy not in backpressure.POLICIES:
+            raise ValueError(f"Unknown overflow policy {self.policy}, expected one of {backpressure.POLICIES}.")
+
+        self.pending = OrderedDict() # type: OrderedDict[str, dict[str]] # slot -> latest message not sent yet
+        self.collapsed = 0 # number of updates dropped because a newer one for the same slot arrived before sending
+        # servers with max_frame_rate get their pending updates once per tick
+        self.interval = { it["name"]: 1.0 / it["max_frame_rate"] if it.get("max_frame_rate") else 0.0
+                          for it in self.proxier.config["servers"] } # type: dict[str, float]
+        self.next_flush = { it: 0.0 for it in self.interval } # type: dict[str, float]
+
+        self.proxier.metrics.gauge("queue_depth", self.queue.qsize)
+        self.proxier.metrics.gauge("pending_slots", lambda: len(self.pending))
+
     def push(self, slot, msg, color, block=True, timeout=None):
         # type: (str, str, int, bool, float | None) -> bool
         """
         # Args
         - slot: slot name
         - msg: message string
+        - block, timeout: how long to wait if the queue is full, for the "block" policy. others never wait.
+
+        Returns False if the update was dropped.
         """
         if slot not in self.proxier.slots:
             print(f"Slot {slot} not found.", file=sys.stderr)
             return False
+        return self.offer(dict(slot=slot, msg=msg, color=color, t=time.time()), block, timeout)
+
+    def offer(self, item, block=True, timeout=None):
+        # type: (dict[str], bool, float | None) -> bool
         try:
-            self.queue.put(dict(slot=slot, msg=msg, color=color), block=block, timeout=timeout)
-            return True
+            return backpressure.offer(self.queue, item, self.proxier.metrics, self.policy, backpressure.capacity_of(self.queue, self.capacity), block, timeout)
         except Exception as e:
             print(f"Received Exception while enqueing ({e})", file=sys.stderr)
             return False
 
+    def push_many(self, updates, block=True, timeout=None):
+        # type: (list[tuple[str, str, int]], bool, float | None) -> dict[str, bool]
+        """
+        Push several (slot, msg, color) as one queue item. Each server gets one frame for all of them.
+
+        Returns { slot: accepted }.
+        """
+        ret = {}
+        batch = []
+        for slot, msg, color in updates:
+            if slot not in self.proxier.slots:
+                print(f"Slot {slot} not found.", file=sys.stderr)
+                ret[slot] = False
+                continue
+            batch.append(dict(slot=slot, msg=msg, color=color, t=time.time()))
+        ok = self.offer(dict(updates=batch), block, timeout) if batch else False
+        for it in batch:
+            ret[it["slot"]] = ok
+        return ret
+
     def process_one(self, block=True, timeout=None):
         # type: (bool, float | None) -> bool
+        """
+        Wait for a message, take whatever else is already queued (up to capacity), then send the pending updates
+        of every server whose tick has come, one frame per server. Servers that recover get what was parked for them.
+
+        Returns False if nothing was sent or sending failed.
+        """
+        try:
+            self.collect(self.queue.get(block, timeout))
+            for _ in range(self.capacity - 1):
+                self.collect(self.queue.get(block=False))
+        except queue.Empty:
+            pass
+        except Exception as e:
+            print(f"Received Exception while processing ({e})", file=sys.stderr)
+        ret = self.flush_due()
+        self.proxier.flush_parked()
+        return ret
+
+    def collect(self, msg):
+        # type: (dict[str]) -> None
+        for it in msg.get("updates", [msg]):
+            if it["slot"] not in self.proxier.slots:
+                print(f"Slot {it['slot']} not found.", file=sys.stderr)
+                continue
+            if it["slot"] in self.pending:
+                self.collapsed += 1
+                self.proxier.metrics.inc("collapsed_total")
+            self.pending[it["slot"]] = it
+
+    def flush_due(self):
+        # type: () -> bool
+        now = time.monotonic()
+        due = [ it for it in self.pending.values() if self.next_flush[self.proxier.slots[it["slot"]].server] <= now ]
+        if not due:
+            return False
+        for it in due:
+            del self.pending[it["slot"]]
+            server = self.proxier.slots[it["slot"]].server
+            self.next_flush[server] = now + self.interval[server]
         try:
-            msg = self.queue.get(block, timeout)
-            return self.proxier.write_str(msg["slot"], msg["msg"], msg["color"], encoding="gb2312")
+            self.proxier.metrics.observe_age("queue_wait_seconds", due)
+            ret = self.proxier.write_many([ (it["slot"], it["msg"], it["color"]) for it in due ], encoding="gb2312")
+            self.proxier.metrics.observe_age("update_latency_seconds", due)
+            return all(ret.values())
         except Exception as e:
             print(f"Received Exception while processing ({e})", file=sys.stderr)
             return False
 
+    def wait_time(self):
+        # type: () -> float | None
+        """
+        Time until the earliest tick of a server with pending updates or retry of a server with parked ones, or None if nothing is pending.
+        """
+        times = [ it for it in [self.proxier.retry_time()] if it is not None ]
+        if self.pending:
+            first = min(self.next_flush[self.proxier.slots[it].server] for it in self.pending)
+            times.append(max(first - time.monotonic(), 0.0))
+        return min(times, default=None)
+
     def run(self):
         self.running = True
+        if self.proxier.config.get("metrics_port"):
+            self.proxier.metrics.serve(self.proxier.config["metrics_port"])
         while self.running:
             if not self.running: break
-            self.process_one()
+            self.process_one(timeout=self.wait_time())
 
     def stop(self):
         self.running = False
@@ -282,7 +725,7 @@ def assert_data(data, i):
     print(f"Test {i} passed.")
 
 def test_server_handler(s, a, i):
-    # type: (socket.socket, socket._RetAddress, int) -> None
+    # type: (socket.socket, socket._RetAddress, int) -> int
     all_data = []
     while True:
         data = s.recv(4096)
@@ -296,18 +739,20 @@ def test_server_handler(s, a, i):
         while len(all_data) >= 161:
             assert_data(all_data[:161], i)
             all_data = all_data[161:]
+            i += 1
+    return i
 
 
 def test_server():
     svr = socket.socket()
+    svr.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     svr.bind(("0.0.0.0", 5003))
     svr.listen(0)
     i = 0
     while True:
         s, a = svr.accept()
-        print(f"Got a connection[{i}].")
-        test_server_handler(s, a, i)
-        i += 1
+        print(f"Got a connection at frame {i}.")
+        i = test_server_handler(s, a, i)
 
 def main():
     server = mp.Process(target=test_server)
@@ -317,15 +762,15 @@ def main():
     subproc = mp.Process(target=dispatch_modbus, args=(q,))
     subproc.start()
 
-    q.put(dict(slot=3, msg="没有检车项目", color=1))
+    q.put(metrics.stamp(dict(slot=3, msg="没有检车项目", color=1)))
     time.sleep(1)
-    q.put(dict(slot=1, msg="625", color=1))
+    q.put(metrics.stamp(dict(slot=1, msg="625", color=1)))
     time.sleep(1)
-    q.put(dict(slot=2, msg="无项目", color=1))
+    q.put(metrics.stamp(dict(slot=2, msg="无项目", color=1)))
     time.sleep(1)
-    q.put(dict(slot=4, msg="AB", color=1))
+    q.put(metrics.stamp(dict(slot=4, msg="AB", color=1)))
     time.sleep(1)
-    q.put(dict(slot=15, msg="0123", color=2))
+    q.put(metrics.stamp(dict(slot=15, msg="0123", color=2)))
     time.sleep(1)
 
     subproc.kill()
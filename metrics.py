@@ -0,0 +1,232 @@
+"""Counters, histograms and gauges for the proxiers and dispatchers.
+
+Each proxier owns a Metrics (`proxier.metrics`) and its dispatcher records
+into the same one. `render()` gives the Prometheus text format, and
+`serve(port)` exposes it over HTTP on localhost from a daemon thread.
+"""
+import sys
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def stamp(item):
+    # type: (dict[str]) -> dict[str]
+    """
+    Set "t" (time.time()) on an update, or on each update of a { "updates": [...] } batch, unless already set, and return it.
+    Producers putting into a dispatcher's queue themselves stamp their updates with it, so queue_wait_seconds and
+    update_latency_seconds cover them like those of `push`.
+    """
+    now = time.time()
+    for it in item.get("updates", [item]):
+        it.setdefault("t", now)
+    return item
+
+
+class Histogram:
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # seconds
+
+    def __init__(self, buckets=BUCKETS):
+        # type: (tuple[float, ...]) -> None
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        # type: (float) -> None
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        # type: () -> list[tuple[float, int]]
+        """
+        Returns [(upper bound, number of observations <= it), ...] ending with (inf, count).
+        """
+        ret = []
+        n = 0
+        for bound, it in zip(self.buckets + (float("inf"),), self.counts):
+            n += it
+            ret.append((bound, n))
+        return ret
+
+    def quantile(self, q):
+        # type: (float) -> float
+        """
+        Estimate the q-quantile (0..1) by linear interpolation inside its bucket, like Prometheus' histogram_quantile.
+        """
+        if self.count == 0:
+            return float("nan")
+        rank = q * self.count
+        lower, below = 0.0, 0
+        for bound, n in self.cumulative():
+            if n >= rank:
+                if bound == float("inf"):
+                    return lower # beyond the last bucket, its bound is the best we know
+                return lower + (bound - lower) * (rank - below) / max(n - below, 1)
+            lower, below = bound, n
+        return lower
+
+
+class Metrics:
+    def __init__(self, prefix="modbus_dispatcher"):
+        # type: (str) -> None
+        """
+        # Args
+        - prefix: prepended to every metric name in `render()`.
+        """
+        self.prefix = prefix
+        self.counters = {} # type: dict[tuple[str, tuple], float] # (name, labels) -> value
+        self.histograms = {} # type: dict[tuple[str, tuple], Histogram]
+        self.gauges = {} # type: dict[tuple[str, tuple], callable] # read when rendered
+        self.lock = threading.Lock()
+        self.server = None # type: ThreadingHTTPServer | None
+
+    @classmethod
+    def key(cls, name, labels):
+        # type: (str, dict[str]) -> tuple[str, tuple]
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        # type: (str, float, ...) -> None
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        # type: (str, float, ...) -> None
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the time spent in the `with` block, in seconds.
+        """
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t, **labels)
+
+    def observe_age(self, name, msgs, **labels):
+        # type: (str, list[dict[str]], ...) -> None
+        """
+        Observe the time since each message was pushed, for the messages carrying a "t" (time.time() at push, see `stamp`).
+        """
+        now = time.time()
+        for it in msgs:
+            if "t" in it:
+                self.observe(name, now - it["t"], **labels)
+
+    def gauge(self, name, func, **labels):
+        # type: (str, callable, ...) -> None
+        """
+        Register func, called without arguments on every snapshot / render, as the current value of a gauge.
+        """
+        with self.lock:
+            self.gauges[self.key(name, labels)] = func
+
+    def read_gauges(self):
+        # type: () -> dict[tuple[str, tuple], float]
+        with self.lock:
+            gauges = list(self.gauges.items())
+        ret = {}
+        for key, func in gauges:
+            try:
+                ret[key] = float(func())
+            except Exception: # e.g. mp.Queue.qsize is not implemented on macOS
+                ret[key] = float("nan")
+        return ret
+
+    def snapshot(self):
+        # type: () -> dict[str, dict]
+        """
+        Returns { "counters": { name: { labels: value } }, "gauges": ..., "histograms": { name: { labels: { "count", "sum", "buckets" } } } },
+        where labels is a tuple of (label, value) pairs.
+        """
+        ret = dict(counters={}, gauges={}, histograms={})
+        for (name, labels), value in self.read_gauges().items():
+            ret["gauges"].setdefault(name, {})[labels] = value
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                ret["counters"].setdefault(name, {})[labels] = value
+            for (name, labels), it in self.histograms.items():
+                ret["histograms"].setdefault(name, {})[labels] = dict(count=it.count, sum=it.sum, buckets=it.cumulative())
+        return ret
+
+    def render(self):
+        # type: () -> str
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        def fmt(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ""
+            escaped = ( (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels )
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        def bound(v):
+            return "+Inf" if v == float("inf") else repr(v)
+
+        snap = self.snapshot()
+        lines = []
+        for kind, name_type in (("counters", "counter"), ("gauges", "gauge")):
+            for name, series in sorted(snap[kind].items()):
+                full = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {full} {name_type}")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{full}{fmt(labels)} {value!r}")
+        for name, series in sorted(snap["histograms"].items()):
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full} histogram")
+            for labels, it in sorted(series.items()):
+                for le, n in it["buckets"]:
+                    lines.append(f"{full}_bucket{fmt(labels, [('le', bound(le))])} {n}")
+                lines.append(f"{full}_sum{fmt(labels)} {it['sum']!r}")
+                lines.append(f"{full}_count{fmt(labels)} {it['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        # type: (int, str) -> ThreadingHTTPServer | None
+        """
+        Serve `render()` at http://host:port/metrics from a daemon thread. Returns None if the port cannot be bound.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"Failed to serve metrics on {host}:{port} ({e})", file=sys.stderr)
+            return None
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
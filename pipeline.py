@@ -0,0 +1,209 @@
+"""Pipelined FC16 writes on a Modbus TCP connection of their own.
+
+pymodbus' clients wait for the response to a request before sending the
+next one (the async client holds a lock from send to response), so over a
+slow link a flush of n requests takes n round trips. A pipeline keeps up to
+`window` FC16 requests in flight, each with its own transaction id, and
+matches the responses back by id, as LEDProxier does for its frames.
+ModbusPipeline blocks; AsyncModbusPipeline is its asyncio twin.
+
+The pipeline is a second TCP connection to the display, next to the one of
+the pymodbus client (whose async transport reads every response itself), so
+it only suits controllers that accept more than one client.
+"""
+import sys
+import time
+import struct
+import socket
+import asyncio
+from array import array
+
+import codec
+
+REQUEST = struct.Struct(">HHHBBHHB") # MBAP (transaction, protocol, length, unit) + FC16 (function, address, quantity, byte count)
+RESPONSE = struct.Struct(">HHHBB") # MBAP + function of a response
+
+
+def pack_request(transaction, slave, address, values):
+    # type: (int, int, int, list[int] | array) -> bytes
+    return REQUEST.pack(transaction, 0, 7 + len(values) * 2, slave, 0x10, address, len(values), len(values) * 2) + codec.registers_to_bytes(values)
+
+
+def parse_responses(buf):
+    # type: (bytearray) -> list[tuple[int, int]]
+    """
+    Take the complete responses out of buf. Returns [(transaction, function)], where function has 0x80 set for an exception response.
+    """
+    ret = []
+    while len(buf) >= RESPONSE.size:
+        transaction, _, length, _, function = RESPONSE.unpack_from(buf)
+        if len(buf) < 6 + length:
+            break
+        del buf[:6 + length]
+        ret.append((transaction, function))
+    return ret
+
+
+class ModbusPipeline:
+    def __init__(self, host, port=502, timeout=1.0):
+        # type: (str, int, float) -> None
+        """
+        # Args
+        - host, port: the server
+        - timeout: for connecting, and the longest wait for the next response
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None # type: socket.socket | None
+        self.transaction = 0 # last transaction id used
+
+    def next_transaction(self):
+        # type: () -> int
+        self.transaction = self.transaction % 0xFFFF + 1
+        return self.transaction
+
+    def connect(self):
+        # type: () -> bool
+        if self.sock is not None:
+            return True
+        try:
+            self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        except OSError as e:
+            print(f"Failed to connect to {self.host}:{self.port} ({e}).", file=sys.stderr)
+            return False
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def write_many(self, slave, requests, window):
+        # type: (int, list[tuple[int, list[int] | array]], int) -> list[float | bool | None]
+        """
+        Send (address, values) FC16 requests in order, keeping up to window of them in flight.
+        A connection that breaks (or was broken since the last call) is replaced once, and the requests not answered yet are sent again on it.
+
+        Returns for each request its round trip time, False if it was sent but failed, or None if it was not sent.
+        """
+        ret = [None] * len(requests) # type: list[float | bool | None]
+        answered = set() # type: set[int]
+        for _ in range(2):
+            todo = [ i for i in range(len(requests)) if i not in answered ]
+            if not todo or not self.connect():
+                break
+            try:
+                self.exchange(slave, requests, todo, window, ret, answered)
+                break
+            except OSError as e:
+                print(f"Received Exception when writing registers ({e})", file=sys.stderr)
+                self.close() # the responses still due would be mismatched on this connection
+        return ret
+
+    def exchange(self, slave, requests, todo, window, ret, answered):
+        # type: (int, list[tuple[int, list[int] | array]], list[int], int, list[float | bool | None], set[int]) -> None
+        """
+        Send the requests at the indexes in todo and read their responses into ret and answered, see `write_many`. Raises OSError.
+        """
+        inflight = {} # type: dict[int, tuple[int, float]] # transaction -> (index of the request, time sent)
+        buf = bytearray()
+        sent = 0
+        while sent < len(todo) or inflight:
+            while sent < len(todo) and len(inflight) < window:
+                transaction = self.next_transaction()
+                address, values = requests[todo[sent]]
+                self.sock.settimeout(self.timeout)
+                self.sock.sendall(pack_request(transaction, slave, address, values))
+                inflight[transaction] = (todo[sent], time.perf_counter())
+                ret[todo[sent]] = False
+                sent += 1
+            self.sock.settimeout(self.timeout)
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("connection closed by peer")
+            buf += chunk
+            self.match(buf, inflight, ret, answered)
+
+    @staticmethod
+    def match(buf, inflight, ret, answered):
+        # type: (bytearray, dict[int, tuple[int, float]], list[float | bool | None], set[int]) -> None
+        for transaction, function in parse_responses(buf):
+            it = inflight.pop(transaction, None)
+            if it is None:
+                continue # a late response to a request given up on
+            answered.add(it[0])
+            if function & 0x80:
+                print(f"Received Modbus exception response to transaction {transaction}", file=sys.stderr)
+                continue
+            ret[it[0]] = time.perf_counter() - it[1]
+
+
+class AsyncModbusPipeline(ModbusPipeline):
+    def __init__(self, host, port=502, timeout=1.0):
+        # type: (str, int, float) -> None
+        super(AsyncModbusPipeline, self).__init__(host, port, timeout)
+        self.reader = None # type: asyncio.StreamReader | None
+        self.writer = None # type: asyncio.StreamWriter | None
+        self.lock = asyncio.Lock() # one batch at a time on the connection
+
+    async def connect(self):
+        # type: () -> bool
+        if self.writer is not None:
+            return True
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f"Failed to connect to {self.host}:{self.port} ({e!r}).", file=sys.stderr)
+            return False
+        self.writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return True
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except RuntimeError:
+                pass # its event loop is already closed
+            self.reader = self.writer = None
+
+    async def write_many(self, slave, requests, window):
+        # type: (int, list[tuple[int, list[int] | array]], int) -> list[float | bool | None]
+        """
+        See ModbusPipeline.write_many.
+        """
+        async with self.lock:
+            ret = [None] * len(requests) # type: list[float | bool | None]
+            answered = set() # type: set[int]
+            for _ in range(2):
+                todo = [ i for i in range(len(requests)) if i not in answered ]
+                if not todo or not await self.connect():
+                    break
+                try:
+                    await self.exchange(slave, requests, todo, window, ret, answered)
+                    break
+                except (OSError, asyncio.TimeoutError) as e:
+                    print(f"Received Exception when writing registers ({e!r})", file=sys.stderr)
+                    self.close()
+            return ret
+
+    async def exchange(self, slave, requests, todo, window, ret, answered):
+        # type: (int, list[tuple[int, list[int] | array]], list[int], int, list[float | bool | None], set[int]) -> None
+        inflight = {} # type: dict[int, tuple[int, float]]
+        buf = bytearray()
+        sent = 0
+        while sent < len(todo) or inflight:
+            while sent < len(todo) and len(inflight) < window:
+                transaction = self.next_transaction()
+                address, values = requests[todo[sent]]
+                self.writer.write(pack_request(transaction, slave, address, values))
+                inflight[transaction] = (todo[sent], time.perf_counter())
+                ret[todo[sent]] = False
+                sent += 1
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            chunk = await asyncio.wait_for(self.reader.read(4096), self.timeout)
+            if not chunk:
+                raise ConnectionError("connection closed by peer")
+            buf += chunk
+            self.match(buf, inflight, ret, answered)
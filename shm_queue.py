@@ -0,0 +1,185 @@
+"""Fixed-record ring buffer in shared memory, a drop-in for the mp.Queue of
+{ "slot": slot, "msg": msg, "color": color } dicts used by the dispatchers.
+
+Each record holds the slot id, the color, the length of the UTF-8 encoded
+message and the message bytes. There is no pickling and no feeder thread;
+producers and the consumer meet in shared memory and wake each other with
+two semaphores.
+"""
+import time
+import queue
+import struct
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+
+class ShmQueue:
+    HEADER = struct.Struct("<II") # head (index of the oldest record), count
+    RECORD = struct.Struct("<iiHBd") # slot, color, length of msg in bytes, flags, time.time() at push (0 if not given)
+    MORE = 0x01 # the next record belongs to the same batch
+
+    def __init__(self, capacity=50, payload_size=128, ctx=None):
+        # type: (int, int, mp.context.BaseContext | None) -> None
+        """
+        # Args
+        - capacity: number of records. a batch of n updates takes n records.
+        - payload_size: max length of a UTF-8 encoded message, in bytes.
+        - ctx: multiprocessing context for the semaphores and locks. defaults to the default context.
+        """
+        ctx = ctx or mp.get_context()
+        self.capacity = capacity
+        self.payload_size = payload_size
+        self.record_size = self.RECORD.size + payload_size
+        self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER.size + capacity * self.record_size)
+        self.HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        self.owner = True
+
+        self.lock = ctx.Lock() # guards head / count and the records
+        self.put_lock = ctx.Lock() # one batch at a time reserves its records, so two batches cannot each hold part of the free records
+        self.items = ctx.Semaphore(0)
+        self.free = ctx.Semaphore(capacity)
+
+    def __getstate__(self):
+        return (self.shm.name, self.capacity, self.payload_size, self.lock, self.put_lock, self.items, self.free)
+
+    def __setstate__(self, state):
+        name, self.capacity, self.payload_size, self.lock, self.put_lock, self.items, self.free = state
+        self.record_size = self.RECORD.size + self.payload_size
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = False
+        try:
+            # only the creating process may unlink the block
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        except Exception:
+            pass
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def put(self, obj, block=True, timeout=None):
+        # type: (dict[str], bool, float | None) -> None
+        """
+        Same as mp.Queue.put. Raises queue.Full, or ValueError for a message longer than payload_size or a batch larger than capacity.
+        """
+        records = obj.get("updates", [obj])
+        payloads = [ it["msg"].encode("utf-8") for it in records ]
+        if any(len(it) > self.payload_size for it in payloads):
+            raise ValueError(f"Message longer than {self.payload_size} bytes.")
+        if len(records) > self.capacity:
+            raise ValueError(f"Batch of {len(records)} updates does not fit in {self.capacity} records.")
+
+        if len(records) == 1:
+            if not self.free.acquire(block, timeout):
+                raise queue.Full
+        else:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with self.put_lock:
+                for i in range(len(records)):
+                    remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                    if not self.free.acquire(block, remaining):
+                        for _ in range(i):
+                            self.free.release()
+                        raise queue.Full
+
+        with self.lock:
+            buf = self.shm.buf
+            head, count = self.HEADER.unpack_from(buf, 0)
+            for i, (it, payload) in enumerate(zip(records, payloads)):
+                offset = self.HEADER.size + ((head + count + i) % self.capacity) * self.record_size
+                flags = self.MORE if i < len(records) - 1 else 0
+                self.RECORD.pack_into(buf, offset, it["slot"], it["color"], len(payload), flags, it.get("t", 0.0))
+                buf[offset + self.RECORD.size : offset + self.RECORD.size + len(payload)] = payload
+            self.HEADER.pack_into(buf, 0, head, count + len(records))
+        for _ in records:
+            self.items.release()
+
+    def put_nowait(self, obj):
+        # type: (dict[str]) -> None
+        self.put(obj, block=False)
+
+    def get(self, block=True, timeout=None):
+        # type: (bool, float | None) -> dict[str]
+        """
+        Same as mp.Queue.get. Returns a single update, or { "updates": [...] } for a batch. Raises queue.Empty.
+        """
+        if not self.items.acquire(block, timeout):
+            raise queue.Empty
+        records = []
+        with self.lock:
+            buf = self.shm.buf
+            head, count = self.HEADER.unpack_from(buf, 0)
+            while True:
+                offset = self.HEADER.size + head * self.record_size
+                slot, color, length, flags, t = self.RECORD.unpack_from(buf, offset)
+                msg = bytes(buf[offset + self.RECORD.size : offset + self.RECORD.size + length]).decode("utf-8")
+                records.append(dict(slot=slot, msg=msg, color=color, t=t) if t else dict(slot=slot, msg=msg, color=color))
+                head = (head + 1) % self.capacity
+                if not flags & self.MORE:
+                    break
+                self.items.acquire() # the rest of the batch is written already, its permits are on the way
+            self.HEADER.pack_into(buf, 0, head, count - len(records))
+        for _ in records:
+            self.free.release()
+        return records[0] if len(records) == 1 else dict(updates=records)
+
+    def get_nowait(self):
+        # type: () -> dict[str]
+        return self.get(block=False)
+
+    def qsize(self):
+        # type: () -> int
+        with self.lock:
+            return self.HEADER.unpack_from(self.shm.buf, 0)[1]
+
+    def empty(self):
+        # type: () -> bool
+        return self.qsize() == 0
+
+    def full(self):
+        # type: () -> bool
+        return self.qsize() >= self.capacity
+
+
+# === For test ===
+
+def produce(q, n):
+    for i in range(n):
+        q.put(dict(slot=i % 16 + 1, msg="正在检车", color=i % 3))
+
+def consume(q, n):
+    for _ in range(n):
+        q.get()
+
+def main():
+    n = 100000
+    for name, q in (("mp.Queue", mp.Queue(50)), ("ShmQueue", ShmQueue(50))):
+        consumer = mp.Process(target=consume, args=(q, n))
+        consumer.start()
+        t = time.perf_counter()
+        produce(q, n)
+        consumer.join()
+        t = time.perf_counter() - t
+        print(f"{name}: {n / t:.0f} msg/s")
+        if isinstance(q, ShmQueue):
+            q.close()
+
+    q = ShmQueue(8)
+    q.put(dict(updates=[dict(slot=1, msg="625", color=1), dict(slot=3, msg="没有检车项目", color=2)]))
+    q.put(dict(slot=2, msg="无项目", color=1))
+    assert q.get() == dict(updates=[dict(slot=1, msg="625", color=1), dict(slot=3, msg="没有检车项目", color=2)])
+    assert q.get() == dict(slot=2, msg="无项目", color=1)
+    try:
+        q.get(timeout=0.01)
+        assert False
+    except queue.Empty:
+        pass
+    q.close()
+    print("All test passed.")
+
+if __name__ == "__main__":
+    main()
+
+# --- For test ---
@@ -0,0 +1,353 @@
+"""Simulated displays on localhost, for tests and load without hardware.
+
+Each SimulatedDisplay listens on its own port and speaks Modbus TCP: FC16,
+FC03, FC06 and FC23 against one register map per unit. The frames LEDProxier
+sends are FC16 requests written back to back, so they are served too; its
+unread responses are harmless. A display can be made slow or unreliable:
+
+- latency, jitter: seconds before each response (latency + uniform(-jitter, jitter)), as on a
+  slow link: the next request is read meanwhile, so pipelined requests overlap.
+- drop_rate: fraction of requests ignored, neither applied nor answered.
+- max_frame_rate: requests handled per second, the rest wait in the socket
+  as they would on a slow controller. None for no limit.
+
+The register image is exposed for assertions (`registers`, `read`, `text`),
+with counters of what was received. `disconnect()` drops the connections of a
+display, `stop()` also switches it off, and `Simulator.restart()` brings it
+back on the same port.
+
+usage::
+
+    python simulator.py [--config modbus-dispatcher.yaml] [--displays 2] [--port 5003]
+                        [--latency 0.005] [--jitter 0.002] [--drop-rate 0.01] [--max-frame-rate 20]
+"""
+import sys
+import copy
+import time
+import struct
+import random
+import socket
+import queue
+import argparse
+import threading
+import socketserver
+import yaml
+
+import codec
+
+MBAP = struct.Struct(">HHHB") # transaction, protocol, length, unit
+
+
+class SimulatedDisplay(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, drop_rate=0.0, max_frame_rate=None, seed=None):
+        # type: (str, int, float, float, float, float | None, int | None) -> None
+        """
+        # Args
+        - host, port: where to listen. port 0 picks a free one, see `address`.
+        - latency, jitter, drop_rate, max_frame_rate: see the module docstring.
+        - seed: for the jitter and the drops, to replay a run.
+        """
+        super(SimulatedDisplay, self).__init__((host, port), SimulatedHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.interval = 1.0 / max_frame_rate if max_frame_rate else 0.0
+        self.next_frame = 0.0 # time.monotonic() the next request may be handled
+        self.random = random.Random(seed)
+        self.registers = {} # type: dict[int, dict[int, int]] # unit -> { address: value }
+        self.bytes_received = 0
+        self.frames = 0 # requests received, dropped ones included
+        self.dropped = 0
+        self.functions = {} # type: dict[int, int] # function code -> requests handled
+        self.connections = 0
+        self.sockets = set() # type: set[socket.socket] # connections being served
+        self.lock = threading.Lock()
+
+    @property
+    def address(self):
+        # type: () -> tuple[str, int]
+        return self.server_address[:2]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        Stop listening and drop the connections, like a display switched off.
+        """
+        self.shutdown()
+        self.server_close()
+        self.disconnect()
+
+    def disconnect(self):
+        """
+        Drop the connections but keep listening, like a network blip. Clients see a reset and have to reconnect.
+        """
+        with self.lock:
+            sockets = list(self.sockets)
+        for it in sockets:
+            try:
+                it.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # already closed by the client
+
+    def read(self, unit, address, count):
+        # type: (int, int, int) -> list[int]
+        """
+        Returns count registers of the unit from address, 0 for those never written.
+        """
+        with self.lock:
+            image = self.registers.get(unit, {})
+            return [ image.get(address + i, 0) for i in range(count) ]
+
+    def text(self, unit, address, count, encoding="gb2312", tailing_byte=b" "):
+        # type: (int, int, int, str, bytes) -> str
+        """
+        Returns the registers decoded as a message, without the padding.
+        """
+        return codec.registers_to_bytes(self.read(unit, address, count)).rstrip(tailing_byte + b"\x00").decode(encoding, errors="replace")
+
+    def reset(self):
+        """
+        Forget the image and the counters, like a display that was power cycled.
+        """
+        with self.lock:
+            self.registers.clear()
+            self.bytes_received = self.frames = self.dropped = self.connections = 0
+            self.functions.clear()
+
+    def throttle(self):
+        """
+        Wait for the next frame slot under max_frame_rate.
+        """
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            at = max(self.next_frame, now)
+            self.next_frame = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+    def delay(self):
+        # type: () -> float
+        return max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0.0) if self.latency or self.jitter else 0.0
+
+    def apply(self, unit, pdu):
+        # type: (int, bytes) -> bytes
+        """
+        Apply a request PDU to the image of the unit and return the response PDU.
+        """
+        function = pdu[0]
+        with self.lock:
+            self.functions[function] = self.functions.get(function, 0) + 1
+            image = self.registers.setdefault(unit, {})
+            if function == 0x10:
+                address, quantity = struct.unpack_from(">HH", pdu, 1)
+                values = struct.unpack_from(f">{quantity}H", pdu, 6)
+                for i, n in enumerate(values):
+                    image[address + i] = n
+                return struct.pack(">BHH", function, address, quantity)
+            if function == 0x06:
+                address, value = struct.unpack_from(">HH", pdu, 1)
+                image[address] = value
+                return pdu[:5]
+            if function == 0x17:
+                read_address, read_quantity, address, quantity = struct.unpack_from(">HHHH", pdu, 1)
+                values = struct.unpack_from(f">{quantity}H", pdu, 10)
+                for i, n in enumerate(values):
+                    image[address + i] = n
+                values = [ image.get(read_address + i, 0) for i in range(read_quantity) ]
+                return struct.pack(f">BB{read_quantity}H", function, read_quantity * 2, *values)
+            if function == 0x03:
+                address, quantity = struct.unpack_from(">HH", pdu, 1)
+                values = [ image.get(address + i, 0) for i in range(quantity) ]
+                return struct.pack(f">BB{quantity}H", function, quantity * 2, *values)
+        return struct.pack(">BB", function | 0x80, 0x01) # illegal function
+
+
+class SimulatedHandler(socketserver.BaseRequestHandler):
+    def recv_exactly(self, n):
+        # type: (int) -> bytes | None
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.request.recv(n - len(buf))
+            if not chunk:
+                return None
+            buf += chunk
+        return bytes(buf)
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.sockets.add(self.request)
+        try:
+            self.serve()
+        except OSError:
+            pass # e.g. reset by a client closing with unread replies
+        finally:
+            with self.server.lock:
+                self.server.sockets.discard(self.request)
+
+    def send_replies(self, replies):
+        # type: (queue.Queue) -> None
+        """
+        Send (time.monotonic() due, reply) in order, each once due. Stops at None.
+        """
+        while True:
+            it = replies.get()
+            if it is None:
+                return
+            due, reply = it
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.request.sendall(reply)
+            except OSError:
+                return
+
+    def serve(self):
+        display = self.server # type: SimulatedDisplay
+        replies = queue.Queue() # type: queue.Queue[tuple[float, bytes] | None]
+        sender = threading.Thread(target=self.send_replies, args=(replies,), daemon=True)
+        sender.start()
+        try:
+            self.serve_requests(display, replies)
+        finally:
+            replies.put(None)
+
+    def serve_requests(self, display, replies):
+        # type: (SimulatedDisplay, queue.Queue) -> None
+        while True:
+            header = self.recv_exactly(MBAP.size)
+            if header is None:
+                return
+            transaction, protocol, length, unit = MBAP.unpack(header)
+            pdu = self.recv_exactly(length - 1)
+            if pdu is None:
+                return
+            with display.lock:
+                display.bytes_received += len(header) + len(pdu)
+                display.frames += 1
+                drop = display.drop_rate > 0 and display.random.random() < display.drop_rate
+                if drop:
+                    display.dropped += 1
+            if drop:
+                continue
+            display.throttle()
+            reply = display.apply(unit, pdu)
+            replies.put((time.monotonic() + display.delay(), MBAP.pack(transaction, protocol, len(reply) + 1, unit) + reply))
+
+
+class Simulator:
+    def __init__(self, n=1, host="127.0.0.1", port=0, **options):
+        # type: (int, str, int, ...) -> None
+        """
+        N displays on consecutive ports from port (or free ports if 0), each with the options of SimulatedDisplay.
+        """
+        self.displays = [ SimulatedDisplay(host, port + i if port else 0, **options) for i in range(n) ]
+        self.names = [ f"display{i}" for i in range(n) ]
+
+    @classmethod
+    def for_config(cls, config, **options):
+        # type: (dict, ...) -> Simulator
+        """
+        One display for each server of a proxier config, see `config_for`.
+        """
+        ret = cls(len(config["servers"]), **options)
+        ret.names = [ it["name"] for it in config["servers"] ]
+        return ret
+
+    def __getitem__(self, key):
+        # type: (int | str) -> SimulatedDisplay
+        if isinstance(key, str):
+            return self.displays[self.names.index(key)]
+        return self.displays[key]
+
+    def __len__(self):
+        return len(self.displays)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        for it in self.displays:
+            it.start()
+        return self
+
+    def stop(self):
+        for it in self.displays:
+            it.stop()
+
+    def restart(self, key):
+        # type: (int | str) -> SimulatedDisplay
+        """
+        Bring a stopped display back on the same address with the same options, its image empty as after a power cycle.
+        """
+        old = self[key]
+        i = self.displays.index(old)
+        new = SimulatedDisplay(*old.address, latency=old.latency, jitter=old.jitter, drop_rate=old.drop_rate,
+                               max_frame_rate=1.0 / old.interval if old.interval else None)
+        new.random = old.random
+        self.displays[i] = new.start()
+        return new
+
+    def config_for(self, config):
+        # type: (dict) -> dict
+        """
+        Returns a copy of the config with its servers pointed at the displays, in order.
+        """
+        config = copy.deepcopy(config)
+        for it, display in zip(config["servers"], self.displays):
+            it["host"], it["port"] = display.address
+        return config
+
+    def stats(self):
+        # type: () -> list[dict[str]]
+        return [ dict(address="%s:%d" % it.address, frames=it.frames, dropped=it.dropped, bytes_received=it.bytes_received, connections=it.connections)
+                 for it in self.displays ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve simulated displays on localhost.")
+    parser.add_argument("--config", help="one display per server of this config, on consecutive ports from --port")
+    parser.add_argument("--displays", type=int, default=1, help="number of displays without --config")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5003)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds, added to latency uniformly in [-jitter, jitter]")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of requests ignored")
+    parser.add_argument("--max-frame-rate", type=float, help="requests handled per second")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    options = dict(latency=args.latency, jitter=args.jitter, drop_rate=args.drop_rate, max_frame_rate=args.max_frame_rate, seed=args.seed)
+    if args.config:
+        with open(args.config, "r") as f:
+            config = yaml.safe_load(f)
+        simulator = Simulator.for_config(config, host=args.host, port=args.port, **options)
+    else:
+        simulator = Simulator(args.displays, host=args.host, port=args.port, **options)
+    simulator.start()
+    for name, it in zip(simulator.names, simulator.displays):
+        print(f"{name} on {it.address[0]}:{it.address[1]}", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(5)
+            print(simulator.stats(), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Last-known register images kept in a memory-mapped file across restarts.
+
+Each key (a server, or a server and slave) owns a fixed span of registers:
+the big-endian values as sent on the wire, then one byte per register that
+is 1 once the value is known. An update is a slice copy into the mapping, so
+it costs about as much as updating the in-memory shadow; the kernel writes
+the pages back, which survives the process being killed but not a power cut
+before `flush()`.
+
+The header records a hash of the layout, so a file written for other slots
+is ignored and rewritten instead of misread.
+"""
+import os
+import sys
+import mmap
+import time
+import zlib
+import struct
+from collections import OrderedDict
+
+import codec
+
+
+class ImageSnapshot:
+    HEADER = struct.Struct("<8sId") # magic, crc32 of the layout, time.time() of the last update
+    MAGIC = b"MDIMAGE1"
+
+    def __init__(self, path, layout):
+        # type: (str, dict[str, tuple[int, int]]) -> None
+        """
+        Map the file at path, created or reset if it does not match the layout.
+
+        # Args
+        - path: file of the snapshot
+        - layout: { key: (first register, number of registers) }
+        """
+        self.path = path
+        self.layout = OrderedDict(sorted(layout.items()))
+        self.offsets = {} # type: dict[str, int] # key -> offset of its values; its known flags follow them
+        offset = self.HEADER.size
+        for key, (_, count) in self.layout.items():
+            self.offsets[key] = offset
+            offset += count * 3
+        self.size = offset
+        self.checksum = zlib.crc32(repr(list(self.layout.items())).encode("utf-8"))
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            existed = size > 0
+            self.fresh = size != self.size
+            if self.fresh:
+                os.ftruncate(fd, 0) # zeroes it, so every register starts unknown
+                os.ftruncate(fd, self.size)
+            self.mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        magic, checksum, _ = self.HEADER.unpack_from(self.mm, 0)
+        if self.fresh or magic != self.MAGIC or checksum != self.checksum:
+            if existed:
+                print(f"Snapshot {path} was written for other slots, starting empty.", file=sys.stderr)
+            self.mm[:] = bytes(self.size)
+            self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.checksum, 0.0)
+            self.fresh = True
+
+    @property
+    def updated_at(self):
+        # type: () -> float
+        """
+        time.time() of the last update, 0 if none.
+        """
+        return self.HEADER.unpack_from(self.mm, 0)[2]
+
+    def load(self, max_age=None):
+        # type: (float | None) -> dict[str, dict[int, int]]
+        """
+        Returns { key: { address: value } } of the known registers, or {} if the snapshot is older than max_age seconds.
+        """
+        if max_age is not None and time.time() - self.updated_at > max_age:
+            return {}
+        ret = {}
+        for key, (first, count) in self.layout.items():
+            offset = self.offsets[key]
+            values = codec.registers_from_bytes(self.mm[offset : offset + count * 2])
+            known = self.mm[offset + count * 2 : offset + count * 3]
+            registers = { first + i: n for i, (n, flag) in enumerate(zip(values, known)) if flag }
+            if registers:
+                ret[key] = registers
+        return ret
+
+    def span(self, key, address, n):
+        # type: (str, int, int) -> tuple[int, int, int] | None
+        """
+        Returns (offset of the first value, index of it in the update, count) of the part of an update inside the key's span.
+        """
+        if key not in self.layout:
+            return None
+        first, count = self.layout[key]
+        lo = max(address, first)
+        hi = min(address + n, first + count)
+        if lo >= hi:
+            return None
+        return self.offsets[key] + (lo - first) * 2, lo - address, hi - lo
+
+    def update_bytes(self, key, address, data):
+        # type: (str, int, bytes | memoryview) -> None
+        """
+        Record registers from address as big-endian bytes, e.g. straight out of a frame. Registers outside the key's span are left out.
+        """
+        span = self.span(key, address, len(data) // 2)
+        if span is None:
+            return
+        offset, skip, n = span
+        first, count = self.layout[key]
+        self.mm[offset : offset + n * 2] = data[skip * 2 : (skip + n) * 2]
+        flags = self.offsets[key] + count * 2 + (offset - self.offsets[key]) // 2
+        self.mm[flags : flags + n] = b"\x01" * n
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.checksum, time.time())
+
+    def update(self, key, address, values):
+        # type: (str, int, list[int] | array) -> None
+        self.update_bytes(key, address, codec.registers_to_bytes(values))
+
+    def forget(self, key=None):
+        # type: (str | None) -> None
+        """
+        Mark every register of the key unknown. if None, of all keys.
+        """
+        for it in ([key] if key is not None else self.layout):
+            if it not in self.layout:
+                continue
+            _, count = self.layout[it]
+            flags = self.offsets[it] + count * 2
+            self.mm[flags : flags + count] = bytes(count)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        if not self.mm.closed:
+            self.mm.flush()
+            self.mm.close()